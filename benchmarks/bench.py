@@ -0,0 +1,299 @@
+"""Throughput benchmarks for dblink against SQLite.
+
+    python -m benchmarks.bench --sizes 1000 100000 --output result.json
+    python -m benchmarks.bench --baseline result.json --tolerance 0.1
+
+Every run writes machine readable results (rows/s, p50/p99 latency and
+peak RSS per operation). With --baseline the run is compared against a
+saved result and exits with status 1 when an operation got slower than the
+tolerance allows.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+import sqlalchemy
+import dblink
+from dblink import Database, Table
+from tests import create_table
+
+SIZES = (1000, 100000, 1000000)
+BACKENDS = ('memory', 'file')
+STRATEGIES = ('executemany', 'values', 'sqlite')
+UPDATE_STRATEGIES = ('executemany', 'staged')
+GET_OR_INSERT_CALLS = 1000
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    index = max(0, min(len(samples) - 1,
+                       int(round(q / 100.0 * len(samples))) - 1))
+    return samples[index]
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+class Timer:
+    """Collects per batch (or per call) latencies of one operation."""
+
+    def __init__(self):
+        self.samples = []
+        self.last = None
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def lap(self, *args):
+        now = time.perf_counter()
+        self.samples.append(now - self.last)
+        self.last = now
+
+
+def users(start, stop, tag='n'):
+    for i in range(start, stop):
+        yield {'id': i, 'name': '{}{}'.format(tag, i),
+               'fullname': 'f{}'.format(i), 'password': 'p{}'.format(i)}
+
+
+def addresses(size):
+    for i in range(size):
+        yield {'id': i, 'user_id': i,
+               'email_address': 'user{}@example.com'.format(i)}
+
+
+class Suite:
+    def __init__(self, backend, size, repeat, batch_size, workdir):
+        self.backend = backend
+        self.size = size
+        self.repeat = repeat
+        self.batch_size = batch_size
+        if backend == 'memory':
+            url = 'sqlite://'
+        else:
+            path = os.path.join(workdir, 'bench_{}.sqlite'.format(size))
+            if os.path.exists(path):
+                os.remove(path)
+            url = 'sqlite:///' + path
+        self.db = Database(url)
+        create_table(self.db.engine)
+        self.users = Table('users', self.db)
+        self.addresses = Table('addresses', self.db)
+        self.results = []
+
+    def record(self, operation, rows, elapsed, timer):
+        self.results.append({
+            'backend': self.backend,
+            'size': self.size,
+            'operation': operation,
+            'rows': rows,
+            'elapsed': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed else None,
+            'p50': percentile(timer.samples, 50),
+            'p99': percentile(timer.samples, 99),
+            'peak_rss_kb': peak_rss_kb(),
+        })
+
+    def bulk(self, operation, method, data, *args, **kwargs):
+        timer = Timer()
+        start = time.perf_counter()
+        timer.start()
+        rows = method(data, *args, batch_size=self.batch_size,
+                      progress=timer.lap, **kwargs)
+        self.record(operation, rows, time.perf_counter() - start, timer)
+
+    def calls(self, operation, fn, times):
+        timer = Timer()
+        rows = 0
+        start = time.perf_counter()
+        for i in range(times):
+            timer.start()
+            rows += fn(i)
+            timer.lap()
+        self.record(operation, rows, time.perf_counter() - start, timer)
+
+    def reset(self):
+        self.users.query.delete()
+
+    def run(self):
+        size = self.size
+        for strategy in STRATEGIES:
+            self.reset()
+            self.bulk('bulk_insert[{}]'.format(strategy),
+                      self.users.bulk_insert, users(0, size),
+                      strategy=strategy)
+
+        for strategy in UPDATE_STRATEGIES:
+            self.bulk('bulk_update[{}]'.format(strategy),
+                      self.users.bulk_update, users(0, size, tag='u'),
+                      ['id'], ['name'], strategy=strategy)
+
+        # Half of the rows exist and are updated, the other half is new.
+        half = size // 2
+        self.bulk('bulk_insert_or_update', self.users.bulk_insert_or_update,
+                  users(half, half + size, tag='m'), ['id'], ['name'])
+        self.users.query.filter(id__gte=size).delete()
+
+        calls = min(size, GET_OR_INSERT_CALLS)
+        step = max(1, size // calls)
+        self.calls('get_or_insert[existing]',
+                   lambda i: self.users.get_or_insert(id=i * step) and 1,
+                   calls)
+        self.calls('get_or_insert[new]',
+                   lambda i: self.users.get_or_insert(id=size + i) and 1,
+                   calls)
+        self.users.query.filter(id__gte=size).delete()
+
+        # Half of the keys exist, the other half is created.
+        self.calls('get_or_insert_many',
+                   lambda i: len(self.users.get_or_insert_many(
+                       users(half, half + size), ['id'],
+                       batch_size=self.batch_size)), 1)
+        self.users.query.filter(id__gte=size).delete()
+
+        # Chatty single row writes, committed one by one or all at once.
+        self.calls('insert[autocommit]',
+                   lambda i: self.users.insert({'id': size + i}), calls)
+        self.users.query.filter(id__gte=size).delete()
+        with self.db.transaction():
+            self.calls('insert[transaction]',
+                       lambda i: self.users.insert({'id': size + i}), calls)
+        self.users.query.filter(id__gte=size).delete()
+
+        query = self.users.query.filter(id__gte=half, name__startswith='m') \
+            .order_by('-id')
+        self.calls('filter_order_by_values_list',
+                   lambda i: len(list(query.values_list('id', 'name'))),
+                   self.repeat)
+
+        self.addresses.bulk_insert(addresses(size))
+        users_, addresses_ = self.users, self.addresses
+        self.calls('join',
+                   lambda i: len(list(users_.join(addresses_).values_list(
+                       users_.id, users_.c.name, addresses_.email_address))),
+                   self.repeat)
+        self.addresses.query.delete()
+
+        self.bulk('bulk_delete', self.users.bulk_delete,
+                  users(0, size), ['id'])
+        self.db.close()
+        return self.results
+
+
+def run_suite(backends=BACKENDS, sizes=SIZES, repeat=5, batch_size=None,
+              workdir=None):
+    batch_size = batch_size or Table.BATCH_SIZE
+    results = []
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        for backend in backends:
+            for size in sizes:
+                suite = Suite(backend, size, repeat, batch_size, tmp)
+                results.extend(suite.run())
+    return {
+        'meta': {
+            'dblink': dblink.__version__,
+            'sqlalchemy': sqlalchemy.__version__,
+            'sqlite': sqlite3.sqlite_version,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'batch_size': batch_size,
+            'repeat': repeat,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance=0.1):
+    """Return one row per operation found in both reports, and whether any
+    of them lost more than tolerance of its baseline throughput."""
+    def key(r):
+        return r['backend'], r['size'], r['operation']
+
+    old = {key(r): r for r in baseline['results']}
+    rows, regressed = [], False
+    for result in report['results']:
+        before = old.get(key(result))
+        if before is None or not before['rows_per_sec'] or \
+                not result['rows_per_sec']:
+            continue
+        ratio = result['rows_per_sec'] / before['rows_per_sec']
+        slower = ratio < 1 - tolerance
+        regressed = regressed or slower
+        rows.append(dict(zip(('backend', 'size', 'operation'), key(result)),
+                         baseline=before['rows_per_sec'],
+                         current=result['rows_per_sec'],
+                         ratio=ratio, regression=slower))
+    return rows, regressed
+
+
+def print_report(report, out=sys.stdout):
+    line = '{:<7} {:>8} {:<30} {:>12} {:>10} {:>10} {:>10}'
+    print(line.format('backend', 'size', 'operation', 'rows/s',
+                      'p50 ms', 'p99 ms', 'rss MB'), file=out)
+    for r in report['results']:
+        print(line.format(
+            r['backend'], r['size'], r['operation'],
+            '{:.0f}'.format(r['rows_per_sec'] or 0),
+            '{:.2f}'.format((r['p50'] or 0) * 1000),
+            '{:.2f}'.format((r['p99'] or 0) * 1000),
+            '{:.1f}'.format(r['peak_rss_kb'] / 1024.0)), file=out)
+
+
+def print_comparison(rows, out=sys.stdout):
+    line = '{:<7} {:>8} {:<30} {:>12} {:>12} {:>7} {}'
+    print(line.format('backend', 'size', 'operation', 'baseline',
+                      'current', 'ratio', ''), file=out)
+    for r in rows:
+        print(line.format(
+            r['backend'], r['size'], r['operation'],
+            '{:.0f}'.format(r['baseline']), '{:.0f}'.format(r['current']),
+            '{:.2f}'.format(r['ratio']),
+            'REGRESSION' if r['regression'] else ''), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS,
+                        default=list(BACKENDS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(SIZES))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='executions of each query benchmark')
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--workdir', default=None,
+                        help='directory for the file backed databases')
+    parser.add_argument('--output', help='write the results as JSON here')
+    parser.add_argument('--baseline', help='compare with a saved result')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed throughput loss against the baseline')
+    args = parser.parse_args(argv)
+
+    report = run_suite(args.backends, args.sizes, args.repeat,
+                       args.batch_size, args.workdir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print_report(report)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows, regressed = compare(report, baseline, args.tolerance)
+        print()
+        print_comparison(rows)
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,11 @@
+from dblink.aggregates import Avg, Count, Max, Min, Sum
 from dblink.base import Database, Table
+from dblink.loader import Loader, register_loader
+from dblink.parallel import parallel_bulk
 
 __version__ = '0.3.0'
 
 __all__ = [
-    'Database', 'Table'
+    'Database', 'Table', 'Loader', 'register_loader', 'parallel_bulk',
+    'Avg', 'Count', 'Max', 'Min', 'Sum',
 ]
@@ -0,0 +1,61 @@
+import sqlalchemy as sal
+
+
+class Aggregate:
+    """SQL aggregate of a column, resolved by the query it is used in.
+
+    The field takes the same names as filter() and values(), including
+    'table.column' after joins.
+    """
+
+    function = None
+
+    def __init__(self, field, distinct=False):
+        self.field = field
+        self.distinct = distinct
+
+    @property
+    def default_name(self):
+        if self.field == '*':
+            return self.function
+        return '{}__{}'.format(self.field.replace('.', '__'), self.function)
+
+    @property
+    def key(self):
+        return type(self).__name__, self.field, self.distinct
+
+    def expression(self, column):
+        if self.distinct:
+            column = column.distinct()
+        return getattr(sal.func, self.function)(column)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.field)
+
+
+class Sum(Aggregate):
+    function = 'sum'
+
+
+class Count(Aggregate):
+    function = 'count'
+
+    def __init__(self, field='*', distinct=False):
+        super().__init__(field, distinct)
+
+    def expression(self, column):
+        if column is None:
+            return sal.func.count()
+        return super().expression(column)
+
+
+class Avg(Aggregate):
+    function = 'avg'
+
+
+class Min(Aggregate):
+    function = 'min'
+
+
+class Max(Aggregate):
+    function = 'max'
@@ -0,0 +1,184 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dblink.base import Database, Query, Table
+
+DEFAULT_WORKERS = 5
+
+_END = object()
+
+
+class AsyncDatabase:
+    def __init__(self, url, max_workers=None, **kwargs):
+        self.__db = Database(url, **kwargs)
+        if max_workers is None:
+            max_workers = (kwargs.get('pool_size') or DEFAULT_WORKERS) + \
+                (kwargs.get('max_overflow') or 0)
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    @property
+    def db(self):
+        return self.__db
+
+    @property
+    def executor(self):
+        return self.__executor
+
+    async def run(self, fn, *args, **kwargs):
+        def call():
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.__db.remove_session()
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.__executor, call)
+
+    async def transaction(self, fn, *args, **kwargs):
+        """Run fn on one worker inside db.transaction()."""
+        def call():
+            with self.__db.transaction():
+                return fn(*args, **kwargs)
+        return await self.run(call)
+
+    async def table(self, name):
+        table = await self.run(Table, name, self.__db)
+        return AsyncTable(table, self)
+
+    async def close(self):
+        await self.run(self.__db.close)
+        self.__executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class AsyncTable:
+    def __init__(self, table, adb):
+        self.__table = table
+        self.__adb = adb
+
+    @property
+    def table(self):
+        return self.__table
+
+    @property
+    def name(self):
+        return self.__table.name
+
+    @property
+    def query(self):
+        return AsyncQuery(self.__table.query, self.__adb)
+
+    def join(self, *args, **kwargs):
+        return self.query.join(*args, **kwargs)
+
+    def prepared(self, name, **values):
+        return AsyncQuery(self.__table.prepared(name, **values), self.__adb)
+
+    def __getattr__(self, item):
+        if item in {'get_or_insert', 'get_or_insert_many', 'insert',
+                    'delete', 'update', 'insert_or_update', 'bulk_insert',
+                    'bulk_delete', 'bulk_update', 'bulk_insert_or_update',
+                    'load'}:
+            method = getattr(self.__table, item)
+
+            async def call(*args, **kwargs):
+                return await self.__adb.run(method, *args, **kwargs)
+            return call
+        return getattr(self.__table, item)
+
+
+class AsyncQuery:
+    def __init__(self, query, adb):
+        self.__query = query
+        self.__adb = adb
+
+    @property
+    def query(self):
+        return self.__query
+
+    def _wrap(self, name):
+        def chain(*args, **kwargs):
+            args = [a.table if isinstance(a, AsyncTable) else a for a in args]
+            query = getattr(self.__query, name)(*args, **kwargs)
+            return AsyncQuery(query, self.__adb)
+        return chain
+
+    def __getattr__(self, item):
+        if item in {'join', 'filter', 'exclude', 'values', 'distinct',
+                    'order_by', 'bind', 'cache', 'group_by', 'annotate',
+                    'having'}:
+            return self._wrap(item)
+        if item in {'one', 'one_or_none', 'scalar', 'first', 'all',
+                    'delete', 'count', 'exists'}:
+            query = self.__query
+
+            async def call():
+                return await self.__adb.run(
+                    lambda: getattr(query, item)())
+            return call
+        raise AttributeError(item)
+
+    async def aggregate(self, *aggregates, **named):
+        return await self.__adb.run(
+            lambda: self.__query.aggregate(*aggregates, **named))
+
+    async def export(self, fileobj, **kwargs):
+        return await self.__adb.run(
+            lambda: self.__query.export(fileobj, **kwargs))
+
+    async def values_list(self, *fields, **kwargs):
+        return await self.__adb.run(
+            lambda: list(self.__query.values_list(*fields, **kwargs)))
+
+    async def stream(self, batch_size=None):
+        batch_size = batch_size or Query.STREAM_BATCH_SIZE
+        loop = asyncio.get_event_loop()
+        batches = asyncio.Queue(maxsize=2)
+        stop = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(batches.put(item), loop).result()
+
+        # The cursor is bound to one session, so a single worker produces
+        # every batch and hands them over through a bounded queue.
+        def produce():
+            rows = self.__query.stream(batch_size)
+            try:
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        put(batch)
+                        batch = []
+                        if stop.is_set():
+                            return
+                if batch:
+                    put(batch)
+                put(_END)
+            except Exception as e:
+                put(e)
+            finally:
+                rows.close()
+
+        producer = asyncio.ensure_future(self.__adb.run(produce))
+        try:
+            while True:
+                item = await batches.get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                for row in item:
+                    yield row
+        finally:
+            stop.set()
+            while not producer.done():
+                while not batches.empty():
+                    batches.get_nowait()
+                await asyncio.sleep(0.01)
+            await producer
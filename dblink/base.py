@@ -1,18 +1,42 @@
 import collections
+import hashlib
+import itertools
+import json
 import logging
+import time
+import weakref
 import sqlalchemy as sal
-from functools import wraps
-from datetime import date
-from dateutil.parser import parse as str2datetime
-from sqlalchemy.sql import sqltypes
+from contextlib import contextmanager
+from functools import partial, wraps
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import DBAPIError
 from sqlalchemy.sql.expression import bindparam
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.ext.automap import automap_base
+from sqlalchemy.ext.baked import BakedQuery
 from sqlalchemy.sql import operators, extract
+from dblink.aggregates import Max, Min
+from dblink.cache import MISSING, MemoryStore, StatementCache
+from dblink.coercion import coercer_for, column_converter
+from dblink.columnar import fetch_columns
+from dblink.instrument import Instrumentation, instrumented
+from dblink.loader import get_loader
+from dblink.parallel import parallel_iter, parallel_map, split_range
+from dblink.routing import ReplicaRouter, RoutingSession
 from dblink.exceptions import (
     NoColumns, DuplicateColumns, UnexpectedParam, NoTableError,
 )
+from dblink.upsert import supports_upsert, upsert_statement
+from dblink.schema import (
+    JoinGraph, dump_metadata, load_metadata, schema_fingerprint,
+)
+from dblink.staging import StagedRows, StagedValues
+from dblink.transfer import (
+    CSV_NULL, check_format, open_text, read_rows, write_rows,
+)
+from dblink.utils import (
+    chunked, column_labels, max_bind_params, sqlite_json_support,
+    supports_row_values,
+)
 
 
 logger = logging.getLogger('DBLink')
@@ -25,37 +49,152 @@ ch.setLevel(logging.INFO)
 logger.addHandler(ch)
 
 
+def handle_dbapi_error(session, e, rollback=True):
+    msg = ' '.join(['{}'] * len(e.args)).format(*e.args)
+    logger.error(msg)
+    if rollback:
+        session.rollback()
+    e.statement = e.statement[:300]
+    e.params = str(e.params)[:300]
+
+
 def with_transaction(commit=True):
     def decorate(f):
         @wraps(f)
-        def wrapper(self, *args, **kwargs):
+        def run(self, *args, **kwargs):
+            # Within db.transaction() the block commits or rolls back.
+            deferred = in_transaction(self.session)
             try:
                 result = f(self, *args, **kwargs)
             except DBAPIError as e:
-                msg = ' '.join(['{}'] * len(e.args)).format(*e.args)
-                logger.error(msg)
-                self.session.rollback()
-                e.statement = e.statement[:300]
-                e.params = str(e.params)[:300]
+                handle_dbapi_error(self.session, e, rollback=not deferred)
+                raise
+            except Exception:
+                # Batches written before e.g. a failing input generator
+                # must not be committed by the next write.
+                if commit is True and not deferred:
+                    self.session.rollback()
                 raise
             else:
-                if commit is True:
+                if commit is not True and releases_reads(self.session):
+                    self.session.release_replica()
+                if commit is True and not deferred:
+                    start = time.perf_counter()
                     self.session.commit()
+                    record = self.db.instrumentation.current()
+                    if record is not None:
+                        record.commit_time = time.perf_counter() - start
                 return result
 
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            if commit is not True:
+                return run(self, *args, **kwargs)
+            # writes and the reads they depend on run on the primary
+            with self.db.primary():
+                return run(self, *args, **kwargs)
+
         return wrapper
     return decorate
 
 
+def in_transaction(session):
+    return session.info.get('dblink_transaction', 0) > 0
+
+
+def releases_reads(session):
+    """Whether reads hand their replica connection back when done."""
+    return hasattr(session, 'release_replica') and \
+        not in_transaction(session)
+
+
+def holds_callable(shape):
+    """Whether a statement shape holds functions, whose repr is their
+    address and changes between processes and lambdas."""
+    if isinstance(shape, tuple):
+        return any(holds_callable(step) for step in shape)
+    return callable(shape)
+
+
+def invalidates_results(f):
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            if in_transaction(self.session):
+                # invalidated once the transaction ends
+                self.session.info.setdefault('dblink_dirty', set()) \
+                    .update(self.table_names)
+            else:
+                self.db.invalidate_results(*self.table_names)
+    return wrapper
+
+
 class Database:
-    def __init__(self, url, encoding='utf8'):
-        self.__engine = sal.create_engine(
-            url, encoding=encoding, pool_pre_ping=True)
-        self.__metadata = sal.MetaData(bind=self.__engine)
-        self.__session = scoped_session(sessionmaker(
-            autocommit=False, autoflush=True, bind=self.__engine))()
+    def __init__(self, url, encoding='utf8', reflect=None, schema_cache=None,
+                 statement_cache_size=500, pool_size=None, max_overflow=None,
+                 pool_recycle=None, pool_timeout=None, scopefunc=None,
+                 metrics_sink=None, slow_query_threshold=None,
+                 result_cache=None, replicas=(), routing='round_robin',
+                 replica_retry_interval=30, read_your_writes=0):
+        pool_options = {'pool_size': pool_size, 'max_overflow': max_overflow,
+                        'pool_recycle': pool_recycle,
+                        'pool_timeout': pool_timeout}
+        create_engine = partial(
+            sal.create_engine, encoding=encoding, pool_pre_ping=True,
+            **{k: v for k, v in pool_options.items() if v is not None})
+        self.__engine = create_engine(url)
+        if metrics_sink is None:
+            metrics_sink = []
+        elif callable(metrics_sink):
+            metrics_sink = [metrics_sink]
+        self.__instrumentation = Instrumentation(
+            metrics_sink, slow_query_threshold)
+        self.__instrumentation.attach(self.__engine)
+        self.__router = None
+        session_options = {}
+        if replicas:
+            self.__router = ReplicaRouter(
+                self.__engine, [create_engine(u) for u in replicas],
+                routing, replica_retry_interval, read_your_writes)
+            for replica in self.__router.replicas:
+                self.__instrumentation.attach(replica.engine)
+            session_options = {'class_': RoutingSession,
+                               'router': self.__router}
+        self.__metadata = self._load_metadata(reflect, schema_cache)
+        self.__statement_cache = StatementCache(statement_cache_size) \
+            if statement_cache_size else None
+        self.__sessions = scoped_session(sessionmaker(
+            autocommit=False, autoflush=True, bind=self.__engine,
+            **session_options), scopefunc=scopefunc)
+        self.__tables = TableRegistry(self)
+        self.__join_graph = None
+        self.__result_cache = result_cache
+        self.__result_stores = weakref.WeakSet()
+        if result_cache is not None:
+            self.__result_stores.add(result_cache)
         self.__open = True
 
+    def _load_metadata(self, reflect, schema_cache):
+        if reflect is None and schema_cache is None:
+            return sal.MetaData(bind=self.engine)
+        names = None if reflect in (None, True) else set(reflect)
+        fingerprint = None
+        if schema_cache is not None:
+            fingerprint = schema_fingerprint(self.engine)
+        if fingerprint is not None:
+            metadata = load_metadata(schema_cache, fingerprint, names)
+            if metadata is not None:
+                metadata.bind = self.engine
+                return metadata
+
+        metadata = sal.MetaData(bind=self.engine)
+        metadata.reflect(only=None if names is None else sorted(names))
+        if fingerprint is not None:
+            dump_metadata(schema_cache, fingerprint, metadata, names)
+        return metadata
+
     @property
     def dialect(self):
         return self.engine.dialect.name
@@ -66,7 +205,82 @@ class Database:
 
     @property
     def session(self):
-        return self.__session
+        return self.__sessions()
+
+    def remove_session(self):
+        self.__sessions.remove()
+
+    @property
+    def replicas(self):
+        if self.__router is None:
+            return []
+        return [replica.engine for replica in self.__router.replicas]
+
+    def replica_status(self):
+        return [] if self.__router is None else self.__router.status()
+
+    @contextmanager
+    def primary(self):
+        """Route the reads of the current session to the primary, e.g. to
+        read your own writes."""
+        info = self.session.info
+        info['dblink_primary'] = info.get('dblink_primary', 0) + 1
+        try:
+            yield self
+        finally:
+            info['dblink_primary'] -= 1
+
+    @contextmanager
+    def transaction(self):
+        """Run the Table and Query writes of the block in one transaction,
+        committed at its end instead of after every call.
+
+        Nested blocks are savepoints: an error rolls back the innermost
+        block only and propagates from it. Result caches are bypassed in
+        the block and invalidated when the outermost block ends.
+        """
+        session = self.session
+        info = session.info
+        depth = info.get('dblink_transaction', 0)
+        savepoint = self._savepoint(session) if depth else None
+        info['dblink_transaction'] = depth + 1
+        try:
+            with self.primary():
+                yield self
+            if savepoint is None:
+                session.commit()
+            else:
+                savepoint.commit()
+        except BaseException:
+            if savepoint is None:
+                session.rollback()
+            else:
+                savepoint.rollback()
+            raise
+        finally:
+            info['dblink_transaction'] = depth
+            if not depth:
+                self.invalidate_results(*info.pop('dblink_dirty', ()))
+
+    batch = transaction
+
+    def _savepoint(self, session):
+        if self.dialect == 'sqlite':
+            # pysqlite only begins before DML. A SAVEPOINT outside of a
+            # transaction would start one and commit it at RELEASE.
+            dbapi_connection = session.connection().connection
+            if not dbapi_connection.in_transaction:
+                dbapi_connection.execute('BEGIN')
+        return session.begin_nested()
+
+    def pool_status(self):
+        pool = self.engine.pool
+        status = {'pool': type(pool).__name__, 'status': pool.status()}
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            method = getattr(pool, name, None)
+            if callable(method):
+                status[name] = method()
+        return status
 
     @property
     def open(self):
@@ -80,9 +294,55 @@ class Database:
     def metadata(self):
         return self.__metadata
 
+    @property
+    def tables(self):
+        return self.__tables
+
+    @property
+    def statement_cache(self):
+        return self.__statement_cache
+
+    @property
+    def instrumentation(self):
+        return self.__instrumentation
+
+    @property
+    def result_cache(self):
+        """The default store of cached query results."""
+        if self.__result_cache is None:
+            self.__result_cache = self.use_result_store(MemoryStore())
+        return self.__result_cache
+
+    def use_result_store(self, store):
+        self.__result_stores.add(store)
+        return store
+
+    @property
+    def cache_namespace(self):
+        return hashlib.sha1(str(self.engine.url).encode('utf8')) \
+            .hexdigest()[:12]
+
+    def cache_tags(self, table_names):
+        return ['{}:{}'.format(self.cache_namespace, name)
+                for name in table_names]
+
+    def invalidate_results(self, *table_names):
+        tags = self.cache_tags(table_names)
+        for store in list(self.__result_stores):
+            store.invalidate(*tags)
+
+    @property
+    def join_graph(self):
+        graph = self.__join_graph
+        if graph is None or graph.size != len(self.metadata.tables):
+            graph = self.__join_graph = JoinGraph(self.metadata)
+        return graph
+
     def close(self):
-        self.session.close()
+        self.remove_session()
         self.engine.dispose()
+        for engine in self.replicas:
+            engine.dispose()
         self.__open = False
 
     def __enter__(self):
@@ -93,14 +353,24 @@ class Database:
 
 
 class Table:
+    BATCH_SIZE = 1000
+    # Batches at least this long are updated through a staging table.
+    STAGED_UPDATE_THRESHOLD = 500
+    UPDATE_STRATEGIES = {'auto', 'executemany', 'staged'}
+    LOAD_MODES = {'insert', 'upsert'}
+
     def __init__(self, name, db):
         if not isinstance(db, Database) or db.open is False:
             msg = 'Invalid db or db has been closed'
             raise UnexpectedParam(msg)
         self.__db = db
         self.__table = self._link_table(name)
+        self.__prepared = dict()
+        self.__result_cache = None
 
     def _link_table(self, name):
+        if name in self.__db.metadata.tables:
+            return self.__db.metadata.tables[name]
         if not self.__db.engine.has_table(name):
             msg = "Database [{}] has no such table [{}]".format(
                 self.__db.name, name)
@@ -120,6 +390,16 @@ class Table:
     def columns(self):
         return list(self.__table.columns)
 
+    @property
+    def unique_keys(self):
+        keys = [{c.name for c in self.__table.primary_key.columns}]
+        keys.extend({c.name for c in cons.columns}
+                    for cons in self.__table.constraints
+                    if isinstance(cons, sal.UniqueConstraint))
+        keys.extend({c.name for c in index.columns}
+                    for index in self.__table.indexes if index.unique)
+        return [k for k in keys if k]
+
     @property
     def description(self):
         return self.__table.__repr__()
@@ -128,6 +408,18 @@ class Table:
     def sal_table(self):
         return self.__table
 
+    @property
+    def table_label(self):
+        return self.name
+
+    @property
+    def table_names(self):
+        return [self.name]
+
+    @property
+    def coercer(self):
+        return coercer_for(self.__table)
+
     @property
     def db(self):
         return self.__db
@@ -141,23 +433,122 @@ class Table:
     def query(self):
         if not hasattr(self, '__query_object'):
             query = self.session.query(self.sal_table)
+            tables = frozenset([self.sal_table])
             params = {'table_name2table': {self.name: self.sal_table},
-                      'column_name2tables': {c.name: {self.sal_table}
-                                             for c in self.columns}}
-            query_object = Query(self.session, query, **params)
+                      'column_name2tables': {c.name: tables
+                                             for c in self.columns},
+                      'shape': ('query', self.name),
+                      'result_cache': self.__result_cache}
+            query_object = Query(self.db, query, **params)
             setattr(self, '__query_object', query_object)
         return getattr(self, '__query_object')
 
     def join(self, *args, **kwargs):
         return self.query.join(*args, **kwargs)
 
+    def enable_cache(self, store=None):
+        """Cache the results of every query built from this table."""
+        self.__result_cache = self.db.result_cache if store is None else \
+            self.db.use_result_store(store)
+        self.__dict__.pop('__query_object', None)
+
+    def disable_cache(self):
+        self.__result_cache = None
+        self.__dict__.pop('__query_object', None)
+
+    def scan(self, size=None, key=None, **filters):
+        for chunk in self.query.filter(**filters).iter_chunks(size, key):
+            for row in chunk:
+                yield row
+
+    def prepare(self, name, *lookups, order_by=(), fields=()):
+        placeholders = dict()
+        for lookup in lookups:
+            op = lookup.split('__')[1] if '__' in lookup else 'exact'
+            placeholders[lookup] = ([] if op == 'in' else
+                                    (0, 0) if op == 'range' else 0)
+        query = self.query.filter(**placeholders)
+        if order_by:
+            query = query.order_by(*order_by)
+        if fields:
+            query = query.values(*fields)
+        self.__prepared[name] = query
+
+    def prepared(self, name, **values):
+        if name not in self.__prepared:
+            msg = 'No prepared query named {}'.format(name)
+            raise UnexpectedParam(msg)
+        return self.__prepared[name].bind(**values)
+
     # insert / update / delete
     def get_or_insert(self, **kwargs):
-        instance, create = self.query.filter(**kwargs).one_or_none(), False
-        if instance is None:
+        with self.db.primary():
+            instance = self.query.filter(**kwargs).one_or_none()
+            if instance is not None:
+                return instance, False
             self.insert(kwargs)
-            instance, create = self.query.filter(**kwargs).one(), True
-        return instance, create
+            return self.query.filter(**kwargs).one(), True
+
+    @instrumented('Table.get_or_insert_many', rows=len)
+    @invalidates_results
+    @with_transaction()
+    def get_or_insert_many(self, items, unique_fields, batch_size=None):
+        """Fetch or create the row of every item, matched by unique_fields.
+
+        Returns (row, created) pairs in input order. Each batch takes one
+        keyed select and one bulk insert, plus a re-select of the new rows
+        where INSERT ... RETURNING is not available.
+        """
+        unique_fields = list(unique_fields)
+        if not unique_fields:
+            raise ValueError('unique_fields must not be empty')
+        self._check_fields(unique_fields)
+        columns = [self.c[f] for f in unique_fields]
+        result = []
+        for chunk in chunked(items, batch_size or
+                             self._key_batch_size(columns)):
+            result.extend(self._get_or_insert_chunk(
+                self.coercer.rows(chunk), unique_fields))
+        return result
+
+    def _get_or_insert_chunk(self, chunk, unique_fields):
+        keys = [tuple(item[f] for f in unique_fields) for item in chunk]
+        if any(None in key for key in keys):
+            raise ValueError('Keys of get_or_insert_many must not be NULL')
+        key2row = self._rows_by_keys(list(dict.fromkeys(keys)),
+                                     unique_fields)
+        missing = dict()
+        for key, item in zip(keys, chunk):
+            if key not in key2row:
+                missing.setdefault(key, item)
+
+        # rows of the same columns go together, omitted ones keep defaults
+        groups = collections.defaultdict(list)
+        for item in missing.values():
+            groups[tuple(item)].append(item)
+        for rows in groups.values():
+            if self.db.dialect == 'postgresql':
+                key2row.update(self._insert_returning(rows, unique_fields))
+            else:
+                self._insert_chunk(rows)
+        if missing and self.db.dialect != 'postgresql':
+            key2row.update(self._rows_by_keys(list(missing), unique_fields))
+
+        result = []
+        for key in keys:
+            result.append((key2row[key], key in missing))
+            missing.pop(key, None)
+        return result
+
+    def _insert_returning(self, rows, unique_fields):
+        size = max(1, max_bind_params(self.db.engine.dialect) // len(rows[0]))
+        key2row = dict()
+        for chunk in chunked(rows, size):
+            stmt = self.sal_table.insert().values(chunk) \
+                .returning(*self.columns)
+            key2row.update((tuple(row[f] for f in unique_fields), row)
+                           for row in self.session.execute(stmt))
+        return key2row
 
     def insert(self, item):
         if not item:
@@ -178,41 +569,168 @@ class Table:
         return self.bulk_insert_or_update(
             [item], unique_fields, update_fields)
 
-    @with_transaction()
-    def bulk_insert(self, data):
-        if not data:
-            return
-        return self.session.execute(self.sal_table.insert(), data)
+    def load(self, fileobj, format='csv', mode='insert', unique_fields=None,
+             update_fields=None, batch_size=None, progress=None,
+             strategy=None, compression='infer', null=CSV_NULL):
+        """Bulk insert, or upsert on unique_fields, the rows of a CSV or
+        NDJSON file (a path or file object, gzip is detected).
+
+        The file is parsed while the batches are written, values are
+        converted to the column types. CSV fields equal to null are NULL.
+        update_fields defaults to the other fields of the file. Returns the
+        number of rows.
+        """
+        check_format(format)
+        if mode not in self.LOAD_MODES:
+            msg = 'Unknown load mode {}'.format(mode)
+            raise UnexpectedParam(msg)
+        if mode == 'upsert' and not unique_fields:
+            raise ValueError('unique_fields must not be empty')
+        with open_text(fileobj, 'r', compression) as stream:
+            rows = read_rows(stream, format, null)
+            first = next(rows, None)
+            if first is None:
+                return 0
+            self._check_fields(first)
+            rows = itertools.chain([first], rows)
+            if mode == 'insert':
+                return self.bulk_insert(rows, batch_size, progress, strategy)
+            if update_fields is None:
+                update_fields = set(first) - set(unique_fields)
+            return self.bulk_insert_or_update(
+                rows, unique_fields, update_fields, batch_size, progress)
+
+    def _bulk_execute(self, data, handle, batch_size=None, progress=None):
+        total = 0
+        record = self.db.instrumentation.current()
+        batches = chunked(data, batch_size or self.BATCH_SIZE)
+        for index, chunk in enumerate(batches, 1):
+            handle(self.coercer.rows(chunk))
+            total += len(chunk)
+            if record is not None:
+                record.batches = index
+            if progress is not None:
+                progress(index, len(chunk), total)
+        return total
+
+    def _check_fields(self, *fields):
+        if set().union(*fields) - {c.name for c in self.c}:
+            raise ValueError('Fields contain invalid column')
 
+    @instrumented('Table.bulk_insert')
+    @invalidates_results
     @with_transaction()
-    def bulk_delete(self, data, unique_fields):
-        if not data:
+    def bulk_insert(self, data, batch_size=None, progress=None,
+                    strategy=None):
+        loader = get_loader(strategy, self.db.engine.dialect)
+        return self._bulk_execute(
+            data, lambda chunk: loader.load(self, self.session, chunk),
+            batch_size, progress)
+
+    def _insert_chunk(self, chunk):
+        loader = get_loader(None, self.db.engine.dialect)
+        loader.load(self, self.session, chunk)
+
+    @instrumented('Table.bulk_delete')
+    @invalidates_results
+    @with_transaction()
+    def bulk_delete(self, data, unique_fields, batch_size=None,
+                    progress=None):
+        unique_fields = list(unique_fields)
+        if not unique_fields:
+            raise ValueError('unique_fields must not be empty')
+        self._check_fields(unique_fields)
+        dialect = self.db.engine.dialect
+        batch_size = batch_size or \
+            max(1, max_bind_params(dialect) // len(unique_fields))
+        staged = None
+        if len(unique_fields) > 1 and not supports_row_values(dialect):
+            staged = StagedRows(self.sal_table, unique_fields, ())
+        try:
+            total = self._bulk_execute(
+                data, lambda chunk: self._delete_chunk(
+                    chunk, unique_fields, staged),
+                batch_size, progress)
+        except BaseException:
+            if staged is not None:
+                staged.drop(failed=True)
+            raise
+        if staged is not None:
+            staged.drop()
+        return total
+
+    def _delete_chunk(self, chunk, unique_fields, staged=None):
+        dialect = self.db.engine.dialect
+        if staged is not None:
+            loader = get_loader(None, dialect)
+            if staged.load(self.session, chunk, loader):
+                self.session.execute(staged.delete_statement(dialect))
             return
 
-        cond_args = [getattr(self.c, f) == bindparam('old_{}'.format(f))
-                     for f in unique_fields]
-        new_data = [{'old_{}'.format(f): item[f] for f in unique_fields}
-                    for item in data]
-
-        stmt = self.sal_table.delete().where(sal.and_(*cond_args))
-        return self.session.execute(stmt, new_data)
+        # NULL keys never match, like the former per-row "k = :k".
+        keys = [k for k in dict.fromkeys(
+            tuple(item[f] for f in unique_fields) for item in chunk)
+            if None not in k]
+        columns = [self.c[f] for f in unique_fields]
+        size = max(1, max_bind_params(dialect) // len(columns))
+        if len(columns) == 1:
+            stmt = self.sal_table.delete().where(
+                columns[0].in_(bindparam('dblink_keys', expanding=True)))
+            for batch in chunked(keys, size):
+                self.session.execute(
+                    stmt, {'dblink_keys': [k[0] for k in batch]})
+            return
+        # Expanding tuples are not typed per element in SQLAlchemy 1.3.
+        for batch in chunked(keys, size):
+            self.session.execute(self.sal_table.delete().where(
+                sal.tuple_(*columns).in_(batch)))
 
+    @instrumented('Table.bulk_update')
+    @invalidates_results
     @with_transaction()
-    def bulk_update(self, data, unique_fields, update_fields):
-        if not data:
-            return
+    def bulk_update(self, data, unique_fields, update_fields,
+                    batch_size=None, progress=None, strategy='auto'):
         unique_fields, update_fields = set(unique_fields), set(update_fields)
-        if (unique_fields | update_fields) - {c.name for c in self.c}:
-            raise ValueError('Fields contain invalid column')
+        self._check_fields(unique_fields, update_fields)
+        if strategy not in self.UPDATE_STRATEGIES:
+            msg = 'Unknown bulk update strategy {}'.format(strategy)
+            raise UnexpectedParam(msg)
+        staged = StagedRows(self.sal_table, unique_fields, update_fields)
 
-        update_fields = update_fields - unique_fields
+        def handle(chunk):
+            if strategy == 'staged' or strategy == 'auto' and \
+                    len(chunk) >= self.STAGED_UPDATE_THRESHOLD:
+                self._staged_update_chunk(chunk, staged)
+            else:
+                self._update_chunk(chunk, unique_fields, update_fields)
+
+        try:
+            total = self._bulk_execute(data, handle, batch_size, progress)
+        except BaseException:
+            staged.drop(failed=True)
+            raise
+        staged.drop()
+        return total
+
+    def _staged_update_chunk(self, chunk, staged):
+        if not staged.fields:
+            return
+        loader = get_loader(None, self.db.engine.dialect)
+        if staged.load(self.session, chunk, loader):
+            self.session.execute(
+                staged.update_statement(self.db.engine.dialect))
+
+    def _update_chunk(self, chunk, unique_fields, update_fields):
+        update_fields = set(update_fields) - set(unique_fields)
+        if not update_fields:
+            return
         cond_args = [getattr(self.c, f) == bindparam('old_{}'.format(f))
                      for f in unique_fields]
         update_kwargs = {f: bindparam('new_{}'.format(f))
                          for f in update_fields}
 
         new_data = list()
-        for item in data:
+        for item in chunk:
             cond_item = {'old_{}'.format(f): item[f] for f in unique_fields}
             update_item = {'new_{}'.format(f): item[f] for f in update_fields}
             new_item = dict(collections.ChainMap(cond_item, update_item))
@@ -222,43 +740,85 @@ class Table:
             .where(sal.and_(*cond_args)) \
             .values(**update_kwargs)
 
-        return self.session.execute(stmt, new_data)
+        self.session.execute(stmt, new_data)
 
+    @instrumented('Table.bulk_insert_or_update')
+    @invalidates_results
     @with_transaction()
-    def bulk_insert_or_update(self, data, unique_fields, update_fields):
-        if not data:
-            return
+    def bulk_insert_or_update(self, data, unique_fields, update_fields,
+                              batch_size=None, progress=None):
         unique_fields, update_fields = set(unique_fields), set(update_fields)
-
-        field2type = {c.name: c.type for c in self.c}
-        if (unique_fields | update_fields) - field2type.keys():
-            raise ValueError('Fields contain invalid column')
-
-        unique_fields, update_fields = list(unique_fields), list(update_fields)
-
-        unique2data = dict()
-        for item in data:
-            tmp = list()
-            for field in unique_fields:
-                value = item[field]
-                if isinstance(field2type[field], sqltypes.DATE):
-                    value = value if isinstance(value, date) else \
-                        str2datetime(value).date()
-                tmp.append(value)
-            unique2data[tuple(tmp)] = item
-
-        query = dict(zip(["{}__in".format(u) for u in unique_fields],
-                         (set(i) for i in zip(*unique2data.keys()))))
-
-        update_data = []
-        for d in self.query.filter(**query):
-            key = tuple(getattr(d, u) for u in unique_fields)
-            if key in unique2data:
-                update_data.append(unique2data.pop(key))
+        self._check_fields(unique_fields, update_fields)
+
+        if unique_fields in self.unique_keys and \
+                supports_upsert(self.db.engine):
+            stmt = upsert_statement(self.sal_table, self.db.dialect,
+                                    sorted(unique_fields), update_fields)
+
+            def handle(chunk):
+                # The statement would set a missing update field to NULL,
+                # the per-row UPDATE of the fallback fails on it instead.
+                for item in chunk:
+                    missing = update_fields.difference(item)
+                    if missing:
+                        raise KeyError(min(missing))
+                self.session.execute(stmt, chunk)
+        else:
+            unique_fields = list(unique_fields)
+            handle = (lambda chunk: self._merge_chunk(
+                chunk, unique_fields, update_fields))
+        return self._bulk_execute(data, handle, batch_size, progress)
+
+    def _merge_chunk(self, chunk, unique_fields, update_fields):
+        unique2data = {tuple(item[f] for f in unique_fields): item
+                       for item in chunk}
+
+        existing = self._existing_keys(
+            [k for k in unique2data if None not in k], unique_fields)
+        update_data = [unique2data.pop(k) for k in existing
+                       if k in unique2data]
         create_data = list(unique2data.values())
-        self.bulk_insert(create_data)
-        if set(unique_fields) != set(update_fields):
-            self.bulk_update(update_data, unique_fields, update_fields)
+        if create_data:
+            self._insert_chunk(create_data)
+        if update_data:
+            self._update_chunk(update_data, unique_fields, update_fields)
+
+    def _existing_keys(self, keys, unique_fields):
+        """The given key tuples that exist in the table, fetched by exact
+        match on the key columns only."""
+        columns = [self.c[f] for f in unique_fields]
+        existing = set()
+        for batch in chunked(keys, self._key_batch_size(columns)):
+            cond, params = self._key_condition(columns, batch)
+            result = self.session.execute(
+                sal.select(columns).where(cond), params)
+            existing.update(tuple(row) for row in result)
+        return existing
+
+    def _rows_by_keys(self, keys, unique_fields):
+        columns = [self.c[f] for f in unique_fields]
+        key2row = dict()
+        for batch in chunked(keys, self._key_batch_size(columns)):
+            cond, params = self._key_condition(columns, batch)
+            result = self.session.execute(
+                sal.select([self.sal_table]).where(cond), params)
+            key2row.update((tuple(row[c] for c in columns), row)
+                           for row in result)
+        return key2row
+
+    def _key_batch_size(self, columns):
+        return max(1, max_bind_params(self.db.engine.dialect) // len(columns))
+
+    def _key_condition(self, columns, keys):
+        """WHERE clause (and its parameters) matching exactly the given
+        key tuples of columns."""
+        if len(columns) == 1:
+            cond = columns[0].in_(bindparam('dblink_keys', expanding=True))
+            return cond, {'dblink_keys': [k[0] for k in keys]}
+        if supports_row_values(self.db.engine.dialect):
+            return sal.tuple_(*columns).in_(keys), {}
+        return sal.or_(*[sal.and_(*[c == v for c, v in zip(columns, key)])
+                         for key in keys]), {}
 
     @property
     def c(self):
@@ -268,8 +828,41 @@ class Table:
         return getattr(self.c, item)
 
 
+class TableRegistry:
+    def __init__(self, db):
+        self.__db = db
+        self.__tables = dict()
+
+    def names(self):
+        return sorted(set(self.__db.metadata.tables) | set(self.__tables))
+
+    def __getitem__(self, name):
+        if name not in self.__tables:
+            self.__tables[name] = Table(name, self.__db)
+        return self.__tables[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except NoTableError:
+            raise AttributeError(name)
+
+    def __contains__(self, name):
+        return name in self.__tables or name in self.__db.metadata.tables \
+            or self.__db.engine.has_table(name)
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __len__(self):
+        return len(self.names())
+
+
 class Query:
-    WARNING_LEN = 2000
+    IN_STAGE_LEN = 1000
+    STREAM_BATCH_SIZE = 1000
     _underscore_operators = {
         'gt': operators.gt,
         'lt': operators.lt,
@@ -289,48 +882,97 @@ class Query:
         'month': lambda c, x: extract('month', c) == x,
         'day': lambda c, x: extract('day', c) == x,
     }
+    # values of these lookups are converted to the column's type
+    _coerced_operators = {'gt', 'lt', 'lte', 'gte', 'le', 'ge', 'in',
+                          'exact', 'range'}
 
-    def __init__(self, session, query, **kwargs):
-        self.session = session
+    def __init__(self, db, query, **kwargs):
+        self.db = db
         self.query = query
         self.table_name2table = kwargs.get('table_name2table', {})
         self.column_name2tables = kwargs.get('column_name2tables', {})
+        self.staged = kwargs.get('staged', ())
+        self.shape = kwargs.get('shape')
+        self.params = kwargs.get('params', {})
+        self.lookups = kwargs.get('lookups', {})
+        self.result_cache = kwargs.get('result_cache')
+        self.grouping = kwargs.get('grouping', ())
+        self.annotations = kwargs.get('annotations', {})
 
-    def _copy_column_name2tables(self):
-        result = dict()
-        for cname, table_set in self.column_name2tables.items():
-            result.setdefault(cname, set())
-            for table in table_set:
-                result[cname].add(table)
-        return result
+    @property
+    def session(self):
+        return self.db.session
 
-    def join(self, table, column1=None, column2=None):
-        assert isinstance(table, Table), UnexpectedParam
-        automap_base(metadata=table.db.metadata).prepare()
-        right_table = table.sal_table
+    @property
+    def table_label(self):
+        return ', '.join(self.table_name2table)
 
+    @property
+    def table_names(self):
+        return list(self.table_name2table)
+
+    def cache(self, store=None):
+        """Cache the results of this query, False turns caching off."""
+        if store is False:
+            return self._clone(result_cache=None)
+        store = self.db.result_cache if store is None else \
+            self.db.use_result_store(store)
+        return self._clone(result_cache=store)
+
+    @instrumented('Query.join', rows=lambda result: None)
+    def join(self, *args, column1=None, column2=None):
+        tables = [t for t in args if isinstance(t, Table)]
+        if not tables or args[:len(tables)] != tuple(tables):
+            msg = 'Join needs tables first, then optional columns'
+            raise UnexpectedParam(msg)
+        columns = args[len(tables):]
+        if len(columns) > 2 or columns and (column1 or column2):
+            raise UnexpectedParam('Too many join columns')
+        if columns:
+            column1, column2 = (tuple(columns) + (None,))[:2]
         if (column1 is None) ^ (column2 is None):
             msg = 'Column1 and Column2 must be all None or all not Null'
             raise UnexpectedParam(msg)
-        if column1 is None:
-            query = self.query.join(right_table)
-        else:
-            if isinstance(column1, str):
-                column1 = self._parse_column(column1)
-            else:
-                assert isinstance(column1, sal.Column), UnexpectedParam
-            if isinstance(column2, str):
-                column2 = getattr(right_table.c, column2)
-            else:
-                assert column2 in set(right_table.c), UnexpectedParam
-            query = self.query.join(right_table, column1 == column2)
+        if column1 is not None and len(tables) > 1:
+            msg = 'Join columns are only allowed when joining one table'
+            raise UnexpectedParam(msg)
+
+        query = self.query
         t2t_copy = self.table_name2table.copy()
-        c2t_copy = self._copy_column_name2tables()
-        t2t_copy[right_table.name] = right_table
-        for column in right_table.columns:
-            c2t_copy.setdefault(column.name, set()).add(right_table)
+        c2t_copy = self.column_name2tables.copy()
+        for table in tables:
+            right_table = table.sal_table
+            if column1 is not None:
+                onclause = self._join_columns(right_table, column1, column2)
+                steps = [(right_table, onclause)]
+            else:
+                steps = table.db.join_graph.path(
+                    t2t_copy, right_table.name) or [(right_table, None)]
+            for step_table, onclause in steps:
+                if step_table.name in t2t_copy:
+                    continue
+                query = (query.join(step_table) if onclause is None else
+                         query.join(step_table, onclause))
+                t2t_copy[step_table.name] = step_table
+                for column in step_table.columns:
+                    c2t_copy[column.name] = \
+                        c2t_copy.get(column.name, frozenset()) | {step_table}
         return self._clone(query=query, table_name2table=t2t_copy,
-                           column_name2tables=c2t_copy)
+                           column_name2tables=c2t_copy,
+                           shape=self._extend_shape(
+                               'join', tuple(t.name for t in tables),
+                               column1, column2))
+
+    def _join_columns(self, right_table, column1, column2):
+        if isinstance(column1, str):
+            column1 = self._parse_column(column1)
+        else:
+            assert isinstance(column1, sal.Column), UnexpectedParam
+        if isinstance(column2, str):
+            column2 = getattr(right_table.c, column2)
+        else:
+            assert column2 in set(right_table.c), UnexpectedParam
+        return column1 == column2
 
     def filter(self, *args, **kwargs):
         return self._filter_or_exclude(False, *args, **kwargs)
@@ -339,15 +981,21 @@ class Query:
         return self._filter_or_exclude(True, *args, **kwargs)
 
     def _filter_or_exclude(self, negate, *args, **kwargs):
-        conds = self._parse_cond(args, kwargs)
+        conds, staged, params, lookups, shape = self._parse_cond(args, kwargs)
         query = (self.query.filter(~sal.and_(*conds)) if negate else
                  self.query.filter(*conds))
-        return self._clone(query=query)
+        return self._clone(
+            query=query, staged=self.staged + staged,
+            params=dict(self.params, **params),
+            lookups=dict(self.lookups, **lookups),
+            shape=None if staged else self._extend_shape(
+                'exclude' if negate else 'filter', shape))
 
     def _parse_cond(self, args, kwargs):
-        conditions = []
+        conditions, staged, params, lookups, shape = [], [], {}, {}, []
         for txt in args:
             conditions.append(sal.text(txt))
+            shape.append(txt)
         for arg, value in kwargs.items():
             name, op = arg, 'exact'
             if '__' in arg:
@@ -355,18 +1003,79 @@ class Query:
                 if op not in self._underscore_operators:
                     msg = "not support this type {}".format(op)
                     raise KeyError(msg)
-            if op == 'in' and len(value) > self.WARNING_LEN and \
-                    self.session.bind.dialect.name == 'mysql':
-                msg = 'In clause is longer than {}, may cause ' \
-                      'MySQL server gone away.'.format(self.WARNING_LEN)
-                logger.warning(msg)
-            op_func = self._underscore_operators[op]
-            conditions.append(op_func(self._parse_column(name), value))
-        return conditions
+            column = self._parse_column(name)
+            value = self._coerce(column, op, value)
+            start, kind = len(params), op
+            if op == 'in':
+                cond, kind, staged_values = self._in_condition(
+                    column, value, params)
+                if staged_values is not None:
+                    staged.append(staged_values)
+            elif op == 'exact' and value is None:
+                cond, kind = column.is_(None), 'isnull'
+            else:
+                if op == 'range':
+                    value = (self._bind(params, value[0], column.type),
+                             self._bind(params, value[1], column.type))
+                elif op in {'year', 'month', 'day'}:
+                    value = self._bind(params, value)
+                else:
+                    value = self._bind(params, value, column.type)
+                cond = self._underscore_operators[op](column, value)
+            conditions.append(cond)
+            lookups[arg] = tuple(params)[start:]
+            shape.append((arg, kind))
+        return conditions, tuple(staged), params, lookups, tuple(shape)
+
+    def _coerce(self, column, op, value):
+        if not isinstance(column, sal.Column):
+            return value
+        convert = column_converter(column)
+        if convert is None or op not in self._coerced_operators:
+            return value
+        if op == 'in':
+            return [convert(v) for v in value]
+        if op == 'range':
+            return tuple(convert(v) for v in value)
+        return convert(value)
+
+    def _bind(self, params, value, type_=None, expanding=False):
+        name = 'dblink_{}'.format(len(self.params) + len(params))
+        params[name] = value
+        return bindparam(name, value, type_=type_, expanding=expanding)
+
+    def _in_condition(self, column, value, params):
+        value = list(value)
+        if len(value) <= self.IN_STAGE_LEN:
+            param = self._bind(params, value, column.type, expanding=True)
+            return column.in_(param), 'in', None
+        dialect = self.db.engine.dialect
+        if dialect.name == 'postgresql':
+            param = self._bind(params, value,
+                               postgresql.ARRAY(column.type))
+            return column == sal.any_(param), 'any', None
+        if dialect.name == 'sqlite' and sqlite_json_support(dialect) and \
+                all(type(v) in {int, float, str} for v in value):
+            param = self._bind(params, json.dumps(value))
+            values = sal.select([sal.column('value')]) \
+                .select_from(sal.func.json_each(param))
+            return column.in_(values), 'json', None
+        staged = StagedValues(column, value)
+        return column.in_(staged.select()), 'staged', staged
+
+    def _stage(self):
+        if self.staged:
+            # the connection the query itself is going to run on
+            connection = self.session.connection(
+                clause=self.query.statement)
+            for staged in self.staged:
+                staged.ensure(connection, self.session.transaction)
 
     def _parse_column(self, column):
         if isinstance(column, sal.Column):
             return column
+        if column in self.annotations:
+            return self.annotations[column]
         if '.' in column:
             table_name, column = column.split('.')
             table = self.table_name2table[table_name]
@@ -386,18 +1095,76 @@ class Query:
         origins = [self._parse_column(cname) for cname in fields]
         origins.extend([func(self._parse_column(c))
                         for c, func in args.items()])
-        return self._clone(query=self.query.with_entities(*origins))
+        return self._clone(query=self.query.with_entities(*origins),
+                           shape=self._extend_shape(
+                               'values', fields, tuple(args.items())))
 
-    def values_list(self, *fields, distinct=False, flat=False, **kwargs):
+    def values_list(self, *fields, distinct=False, flat=False, stream=False,
+                    batch_size=None, **kwargs):
         clone = self.values(*fields, **kwargs)
         real_flat = flat and (len(fields) + len(kwargs)) == 1
 
         if distinct:
             clone = clone.distinct()
-        return (x[0] if real_flat else x for x in clone)
+        rows = clone.stream(batch_size) if stream else clone
+        return (x[0] if real_flat else x for x in rows)
+
+    def group_by(self, *fields):
+        columns = [self._parse_column(f) for f in fields]
+        grouping = self.grouping + tuple(columns)
+        query = self.query.group_by(*columns).with_entities(
+            *(grouping + tuple(self.annotations.values())))
+        return self._clone(query=query, grouping=grouping,
+                           shape=self._extend_shape('group_by', fields))
+
+    def annotate(self, *aggregates, **named):
+        labels, key = self._aggregates(aggregates, named)
+        annotations = dict(self.annotations, **labels)
+        return self._clone(query=self.query.add_columns(*labels.values()),
+                           annotations=annotations,
+                           shape=self._extend_shape('annotate', key))
+
+    def having(self, *args, **kwargs):
+        conds, staged, params, lookups, shape = self._parse_cond(args, kwargs)
+        return self._clone(
+            query=self.query.having(sal.and_(*conds)),
+            staged=self.staged + staged,
+            params=dict(self.params, **params),
+            lookups=dict(self.lookups, **lookups),
+            shape=None if staged else self._extend_shape('having', shape))
+
+    def aggregate(self, *aggregates, **named):
+        if self.grouping or self.annotations:
+            msg = 'aggregate() cannot follow group_by() or annotate()'
+            raise UnexpectedParam(msg)
+        labels, key = self._aggregates(aggregates, named)
+        clone = self._clone(
+            query=self.query.order_by(None).with_entities(*labels.values()),
+            shape=self._extend_shape('aggregate', key))
+        return dict(zip(labels, clone.one()))
+
+    def _aggregates(self, aggregates, named):
+        aggregates = collections.OrderedDict(
+            [(a.default_name, a) for a in aggregates] + list(named.items()))
+        labels = collections.OrderedDict()
+        for name, aggregate in aggregates.items():
+            column = None if aggregate.field == '*' else \
+                self._parse_column(aggregate.field)
+            labels[name] = aggregate.expression(column).label(name)
+        return labels, tuple((n, a.key) for n, a in aggregates.items())
+
+    @instrumented('Query.exists', rows=lambda result: 1)
+    @with_transaction(commit=False)
+    def exists(self):
+        def fetch():
+            self._stage()
+            return self.session.query(self._bound().exists()) \
+                .params(self.params).scalar()
+        return self._cached('exists', fetch)
 
     def distinct(self, *field_names):
-        return self._clone(query=self.query.distinct(*field_names))
+        return self._clone(query=self.query.distinct(*field_names),
+                           shape=self._extend_shape('distinct', field_names))
 
     def order_by(self, *args):
         conditions = []
@@ -407,26 +1174,314 @@ class Query:
                 cname, asc = arg[1:], False
             column = self._parse_column(cname)
             conditions.append(column if asc else column.desc())
-        return self._clone(query=self.query.order_by(*conditions))
+        return self._clone(query=self.query.order_by(*conditions),
+                           shape=self._extend_shape('order_by', args))
+
+    def bind(self, **values):
+        params = dict(self.params)
+        for lookup, value in values.items():
+            if lookup not in self.lookups:
+                msg = 'No lookup {} in query'.format(lookup)
+                raise UnexpectedParam(msg)
+            names = self.lookups[lookup]
+            name, _, op = lookup.partition('__')
+            value = self._coerce(self._parse_column(name), op or 'exact',
+                                 value)
+            if len(names) == 1:
+                params[names[0]] = value
+            else:
+                params.update(zip(names, value))
+        return self._clone(params=params)
+
+    def iter_chunks(self, size=None, key=None):
+        size = size or self.STREAM_BATCH_SIZE
+        columns = self._keyset_columns(key)
+        # Rows sharing the last key of a page would be skipped by the next
+        # one, the primary key breaks the ties of a non-unique key.
+        table = next(iter(self.table_name2table.values()))
+        columns += [c for c in table.primary_key.columns
+                    if not any(c is k for k in columns)]
+        params = dict()
+        binds = [self._bind(params, None, c.type) for c in columns]
+        ordered = self.query.order_by(None).order_by(*columns)
+        page = self._clone(query=ordered.limit(size), shape=self._extend_shape(
+            'iter_chunks', tuple(columns), size))
+        following = self._clone(
+            query=ordered.filter(self._keyset_condition(columns, binds))
+            .limit(size),
+            params=dict(self.params, **params),
+            shape=self._extend_shape('iter_chunks_after',
+                                     tuple(columns), size))
+        while True:
+            rows = page.all()
+            if not rows:
+                return
+            yield rows
+            if len(rows) < size:
+                return
+            try:
+                last = [getattr(rows[-1], c.name) for c in columns]
+            except AttributeError:
+                msg = 'Key columns must be selected to iterate in chunks'
+                raise UnexpectedParam(msg)
+            page = following._clone(
+                params=dict(following.params, **dict(zip(params, last))))
+
+    def _keyset_columns(self, key):
+        if key is None:
+            table = next(iter(self.table_name2table.values()))
+            columns = list(table.primary_key.columns)
+        elif isinstance(key, (str, sal.Column)):
+            columns = [self._parse_column(key)]
+        else:
+            columns = [self._parse_column(k) for k in key]
+        if not columns:
+            raise UnexpectedParam('No key to iterate in chunks')
+        return columns
+
+    def _keyset_condition(self, columns, binds):
+        if len(columns) == 1:
+            return columns[0] > binds[0]
+        if supports_row_values(self.db.engine.dialect):
+            return sal.tuple_(*columns) > sal.tuple_(*binds)
+        return sal.or_(*[
+            sal.and_(*[c == b for c, b in zip(columns[:i], binds[:i])],
+                     columns[i] > binds[i])
+            for i in range(len(columns))])
+
+    def partitions(self, count, partition_by=None, method='minmax',
+                   ordered=False):
+        """Split the query into at most count queries over disjoint,
+        ascending ranges of partition_by (the primary key by default).
+
+        Bounds come from an even split of min/max (numbers, dates) or, with
+        method='quantiles', from ntile() over the column (window functions,
+        SQLite 3.25+). NULL keys fall into the first partition. With
+        ordered, each partition is ordered by the column.
+        """
+        column = self._partition_column(partition_by)
+        if method == 'minmax':
+            bounds = self._minmax_bounds(column, count)
+        elif method == 'quantiles':
+            bounds = self._quantile_bounds(column, count)
+        else:
+            msg = 'Unknown partition method {}'.format(method)
+            raise UnexpectedParam(msg)
+        edges = [None] + bounds + [None]
+        parts = [self._key_range(column, lower, upper)
+                 for lower, upper in zip(edges, edges[1:])]
+        if ordered:
+            parts = [p._clone(query=p.query.order_by(None).order_by(column),
+                              shape=p._extend_shape('order_by', column))
+                     for p in parts]
+        return parts
+
+    def _partition_column(self, partition_by):
+        columns = self._keyset_columns(partition_by)
+        if len(columns) != 1:
+            msg = 'Partitioning needs a single column, use partition_by'
+            raise UnexpectedParam(msg)
+        return columns[0]
+
+    def _minmax_bounds(self, column, count):
+        result = self.aggregate(low=Min(column), high=Max(column))
+        low, high = result['low'], result['high']
+        if low is None or count < 2:
+            return []
+        try:
+            return split_range(low, high, count)
+        except TypeError:
+            msg = 'Cannot split {} by min/max, use quantiles'.format(column)
+            raise UnexpectedParam(msg)
 
+    @with_transaction(commit=False)
+    def _quantile_bounds(self, column, count):
+        if count < 2:
+            return []
+        bucket = sal.func.ntile(count).over(order_by=column)
+        ranked = self.query.order_by(None) \
+            .with_entities(column.label('key'), bucket.label('bucket')) \
+            .filter(column.isnot(None)).subquery()
+        self._stage()
+        query = self.session.query(sal.func.min(ranked.c.key)) \
+            .group_by(ranked.c.bucket).order_by(ranked.c.bucket) \
+            .params(self.params)
+        # the first value of each but the first bucket
+        return sorted({row[0] for row in query.all()[1:]})
+
+    def _key_range(self, column, lower, upper):
+        params, conditions = {}, []
+        if lower is not None:
+            conditions.append(column >= self._bind(params, lower, column.type))
+        if upper is not None:
+            cond = column < self._bind(params, upper, column.type)
+            conditions.append(cond if lower is not None else
+                              sal.or_(cond, column.is_(None)))
+        if not conditions:
+            return self
+        return self._clone(query=self.query.filter(*conditions),
+                           params=dict(self.params, **params),
+                           shape=self._extend_shape(
+                               'partition', column, lower is None,
+                               upper is None))
+
+    def parallel_iter(self, workers=4, partition_by=None, partitions=None,
+                      method='minmax', ordered=False, batch_size=None):
+        """Iterate the rows over workers threads, each streaming one
+        partition at a time on its own session (see partitions()).
+
+        Rows come as their batches complete; with ordered, in partition
+        key order. partitions defaults to four per worker.
+        """
+        return parallel_iter(self, workers, partition_by, partitions,
+                             method, ordered, batch_size)
+
+    def parallel_map(self, fn, workers=4, partition_by=None, partitions=None,
+                     method='minmax', ordered=False, batch_size=None,
+                     processes=None):
+        """Like parallel_iter, yielding fn(row). fn runs on the fetching
+        threads, or on a pool of processes (fn and rows get pickled)."""
+        return parallel_map(self, fn, workers, partition_by, partitions,
+                            method, ordered, batch_size, processes)
+
+    @instrumented('Query.delete')
+    @invalidates_results
     @with_transaction()
     def delete(self):
-        return self.query.delete(synchronize_session=False)
+        self._stage()
+        return self._bound().delete(synchronize_session=False)
+
+    def _extend_shape(self, *step):
+        return None if self.shape is None else self.shape + (step,)
+
+    def _bound(self):
+        return self.query.with_session(self.session).params(self.params)
+
+    def _result(self):
+        self._stage()
+        if self.db.statement_cache is None or self.shape is None or \
+                holds_callable(self.shape):
+            return self._bound()
+        try:
+            hash(self.shape)
+        except TypeError:
+            return self._bound()
+        query = self.query
+        baked = BakedQuery(self.db.statement_cache,
+                           lambda session: query.with_session(session),
+                           (self.shape,))
+        return baked(self.session).params(self.params)
 
-    @with_transaction(commit=False)
     def __getattr__(self, item):
-        if item in {'one', 'one_or_none', 'scalar', 'first', 'all'}:
-            return getattr(self.query, item)
+        if item in {'one', 'one_or_none', 'scalar', 'first', 'all',
+                    'count'}:
+            return self._terminal(item)
         raise AttributeError(item)
 
+    def _terminal(self, item):
+        rows = (len if item == 'all' else
+                (lambda r: 1) if item == 'count' else
+                (lambda r: int(r is not None)))
+
+        @instrumented('Query.{}'.format(item), rows=rows)
+        @with_transaction(commit=False)
+        def call(self):
+            return self._cached(item, lambda: getattr(self._result(), item)())
+        return partial(call, self)
+
+    @instrumented('Query.iter', rows=lambda result: None)
     @with_transaction(commit=False)
     def __iter__(self):
-        return iter(self.query)
+        # rows are fetched before a replica connection is released
+        if self.result_cache is None and not releases_reads(self.session):
+            return iter(self._result())
+        return iter(self._cached('iter', lambda: list(self._result())))
+
+    def _cached(self, operation, fetch):
+        store = self.result_cache
+        if store is None or in_transaction(self.session):
+            return fetch()
+        key = self._cache_key(operation)
+        value = store.get(key)
+        if value is MISSING:
+            tags = self.db.cache_tags(self.table_names)
+            generation = store.generation(tags)
+            value = fetch()
+            store.set(key, value, tags, generation)
+        # hand out copies, callers may modify the lists they get
+        return list(value) if isinstance(value, list) else value
+
+    def _cache_key(self, operation):
+        statement = self.shape
+        try:
+            hash(statement)
+        except TypeError:
+            statement = None
+        if statement is None or holds_callable(statement):
+            # The bound values count, functions may have added literals.
+            compiled = self.query.statement.compile(
+                dialect=self.db.engine.dialect)
+            statement = (str(compiled), sorted(compiled.params.items()))
+        material = repr((self.db.cache_namespace, operation, statement,
+                         sorted(self.params.items())))
+        return hashlib.sha1(material.encode('utf8')).hexdigest()
+
+    @instrumented('Query.to_columns',
+                  rows=lambda result: len(next(iter(result.values()), ())))
+    @with_transaction(commit=False)
+    def to_columns(self, *fields, batch_size=None):
+        clone = self.values(*fields) if fields else self
+        clone._stage()
+        query = clone._bound()
+        statement = query.statement
+        return fetch_columns(self.session.connection(clause=statement),
+                             statement, query.column_descriptions,
+                             batch_size or self.STREAM_BATCH_SIZE)
+
+    @instrumented('Query.export')
+    def export(self, fileobj, format='csv', batch_size=None,
+               compression='infer', null=CSV_NULL):
+        """Write the rows to fileobj (a path or file object) as CSV with a
+        header or as NDJSON, streamed from a server side cursor. CSV
+        writes NULL as null (None for empty fields, which load() reads
+        back as '' for strings). gzip is used for .gz names or with
+        compression='gzip'. Returns the number of rows."""
+        check_format(format)
+        fields = column_labels(self.query.column_descriptions)
+        with open_text(fileobj, 'w', compression) as stream:
+            return write_rows(stream, fields, self.stream(batch_size),
+                              format, null)
+
+    def stream(self, batch_size=None):
+        session = self.session
+        # no replica connection is released under an open stream
+        session.info['dblink_streams'] = \
+            session.info.get('dblink_streams', 0) + 1
+        try:
+            self._stage()
+            query = self._bound() \
+                .yield_per(batch_size or self.STREAM_BATCH_SIZE)
+            for row in query:
+                yield row
+        except DBAPIError as e:
+            handle_dbapi_error(session, e)
+            raise
+        finally:
+            session.info['dblink_streams'] -= 1
+        if releases_reads(session):
+            session.release_replica()
 
     def _clone(self, **kwargs):
-        params = {'session': self.session,
+        params = {'db': self.db,
                   'query': self.query,
                   'table_name2table': self.table_name2table,
-                  'column_name2tables': self.column_name2tables}
+                  'column_name2tables': self.column_name2tables,
+                  'staged': self.staged,
+                  'shape': self.shape,
+                  'params': self.params,
+                  'lookups': self.lookups,
+                  'result_cache': self.result_cache,
+                  'grouping': self.grouping,
+                  'annotations': self.annotations}
         params.update(**kwargs)
         return Query(**params)
@@ -0,0 +1,247 @@
+import collections
+import pickle
+import sqlite3
+import threading
+import time
+
+MISSING = object()
+
+
+class StatementCache:
+    """LRU mapping used as the bakery of cached query statements.
+
+    SQLAlchemy looks up both the baked query context and its compiled SQL
+    here, so every execution counts two lookups.
+    """
+
+    def __init__(self, maxsize=500):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self.__data = collections.OrderedDict()
+        self.__lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                value = self.__data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.__lock:
+            self.__data[key] = value
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__data
+
+    def __len__(self):
+        return len(self.__data)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self),
+                'maxsize': self.maxsize}
+
+
+class ResultStore:
+    """Base of the query result stores.
+
+    Results are tagged with the tables they were read from. invalidate()
+    drops the results of the given tags and bumps their generation, so a
+    result read while a write was in flight is not stored afterwards.
+    Subclasses implement _get, _set, _drop, _clear and __len__.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._generations = collections.Counter()
+        self._lock = threading.RLock()
+
+    def generation(self, tags):
+        with self._lock:
+            return tuple(self._generations[tag] for tag in tags)
+
+    def get(self, key):
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value, tags, generation=None):
+        with self._lock:
+            if generation is not None and \
+                    generation != self.generation(tags):
+                return
+            expires = None if self.ttl is None else time.time() + self.ttl
+            self._set(key, value, tags, expires)
+
+    def invalidate(self, *tags):
+        with self._lock:
+            self._generations.update(tags)
+            self.invalidations += self._drop(tags)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations, 'size': len(self),
+                'maxsize': self.maxsize}
+
+
+class MemoryStore(ResultStore):
+    """In-process LRU store with an optional TTL in seconds."""
+
+    def __init__(self, maxsize=1000, ttl=None):
+        super().__init__(maxsize, ttl)
+        self.__data = collections.OrderedDict()
+        self.__tags = collections.defaultdict(set)
+
+    def _get(self, key, now):
+        entry = self.__data.get(key)
+        if entry is None:
+            return MISSING
+        value, expires, _ = entry
+        if expires is not None and expires <= now:
+            self._remove(key)
+            self.evictions += 1
+            return MISSING
+        self.__data.move_to_end(key)
+        return value
+
+    def _set(self, key, value, tags, expires):
+        if key in self.__data:
+            self._remove(key)
+        self.__data[key] = (value, expires, tuple(tags))
+        for tag in tags:
+            self.__tags[tag].add(key)
+        while len(self.__data) > self.maxsize:
+            self._remove(next(iter(self.__data)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, _, tags = self.__data.pop(key)
+        for tag in tags:
+            keys = self.__tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.__tags[tag]
+
+    def _drop(self, tags):
+        keys = set().union(*[self.__tags.get(tag, ()) for tag in tags])
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def _clear(self):
+        self.__data.clear()
+        self.__tags.clear()
+
+    def __len__(self):
+        return len(self.__data)
+
+
+class DiskStore(ResultStore):
+    """Results pickled into a local SQLite file, shared by processes.
+
+    Generations are kept per process: writes made by other processes are
+    only seen once the TTL expires.
+    """
+
+    def __init__(self, path, maxsize=10000, ttl=None):
+        super().__init__(maxsize, ttl)
+        self.path = path
+        self.__conn = sqlite3.connect(path, check_same_thread=False,
+                                      isolation_level=None)
+        self.__conn.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY, value BLOB, expires REAL, used REAL);
+            CREATE INDEX IF NOT EXISTS results_used ON results (used);
+            CREATE TABLE IF NOT EXISTS result_tags (
+                tag TEXT, key TEXT, PRIMARY KEY (tag, key));
+            CREATE INDEX IF NOT EXISTS result_tags_key ON result_tags (key);
+        """)
+
+    def _get(self, key, now):
+        row = self.__conn.execute(
+            'SELECT value, expires FROM results WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return MISSING
+        if row[1] is not None and row[1] <= now:
+            self._delete('key = ?', (key,))
+            self.evictions += 1
+            return MISSING
+        self.__conn.execute('UPDATE results SET used = ? WHERE key = ?',
+                            (now, key))
+        return pickle.loads(row[0])
+
+    def _set(self, key, value, tags, expires):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.__conn:
+            self.__conn.execute('BEGIN')
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                (key, value, expires, time.time()))
+            self.__conn.executemany(
+                'INSERT OR IGNORE INTO result_tags VALUES (?, ?)',
+                [(tag, key) for tag in tags])
+            excess = len(self) - self.maxsize
+            if excess > 0:
+                self.evictions += self._delete(
+                    'key IN (SELECT key FROM results ORDER BY used LIMIT ?)',
+                    (excess,))
+
+    def _delete(self, where, params):
+        keys = [row[0] for row in self.__conn.execute(
+            'SELECT key FROM results WHERE ' + where, params)]
+        if keys:
+            self.__conn.executemany('DELETE FROM results WHERE key = ?',
+                                    [(k,) for k in keys])
+            self.__conn.executemany(
+                'DELETE FROM result_tags WHERE key = ?', [(k,) for k in keys])
+        return len(keys)
+
+    def _drop(self, tags):
+        marks = ', '.join('?' * len(tags))
+        return self._delete(
+            'key IN (SELECT key FROM result_tags WHERE tag IN ({}))'.format(
+                marks), tuple(tags))
+
+    def _clear(self):
+        self.__conn.executescript(
+            'DELETE FROM results; DELETE FROM result_tags;')
+
+    def __len__(self):
+        return self.__conn.execute('SELECT count(*) FROM results') \
+            .fetchone()[0]
+
+    def close(self):
+        self.__conn.close()
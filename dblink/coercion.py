@@ -0,0 +1,216 @@
+import re
+from datetime import date, datetime, time
+from decimal import Decimal
+from dateutil.parser import parse as str2datetime
+from sqlalchemy.sql import sqltypes
+
+TRUE_STRINGS = frozenset(['1', 't', 'true', 'y', 'yes', 'on'])
+FALSE_STRINGS = frozenset(['0', 'f', 'false', 'n', 'no', 'off'])
+
+_TIME_PATTERN = r'(\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?'
+_ISO_DATETIME = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)(?:[T ]' + _TIME_PATTERN + ')?$')
+_ISO_TIME = re.compile(_TIME_PATTERN + '$')
+
+
+def _time_fields(hour, minute, second, fraction):
+    return (int(hour), int(minute), int(second or 0),
+            int((fraction or '0').ljust(6, '0')))
+
+
+def parse_iso_datetime(value):
+    """ISO-8601 without offset, for Pythons before datetime.fromisoformat
+    (3.7)."""
+    match = _ISO_DATETIME.match(value)
+    if match is None:
+        raise ValueError('not an ISO datetime')
+    year, month, day, hour = match.groups()[:4]
+    if hour is None:
+        return datetime(int(year), int(month), int(day))
+    return datetime(int(year), int(month), int(day),
+                    *_time_fields(*match.groups()[3:]))
+
+
+def parse_iso_time(value):
+    match = _ISO_TIME.match(value)
+    if match is None:
+        raise ValueError('not an ISO time')
+    return time(*_time_fields(*match.groups()))
+
+
+if hasattr(datetime, 'fromisoformat'):
+    _iso_datetime = datetime.fromisoformat
+    _iso_date = date.fromisoformat
+    _iso_time = time.fromisoformat
+else:
+    _iso_datetime = parse_iso_datetime
+    _iso_time = parse_iso_time
+
+    def _iso_date(value):
+        return parse_iso_datetime(value).date()
+
+
+def to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    if isinstance(value, str):
+        try:
+            return _iso_datetime(value)
+        except ValueError:
+            return str2datetime(value)
+    return value
+
+
+def to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str):
+        try:
+            return _iso_date(value)
+        except ValueError:
+            return to_datetime(value).date()
+    return value
+
+
+def to_time(value):
+    if isinstance(value, str):
+        try:
+            return _iso_time(value)
+        except ValueError:
+            return str2datetime(value).time()
+    if isinstance(value, datetime):
+        return value.time()
+    return value
+
+
+def to_bool(value):
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in TRUE_STRINGS:
+            return True
+        if lowered in FALSE_STRINGS:
+            return False
+        raise ValueError('not a boolean')
+    if isinstance(value, int) and not isinstance(value, bool):
+        return bool(value)
+    return value
+
+
+def to_int(value):
+    return int(value) if isinstance(value, str) else value
+
+
+def to_decimal(value):
+    return Decimal(value) if isinstance(value, str) else value
+
+
+def to_float(value):
+    return float(value) if isinstance(value, str) else value
+
+
+def type_converter(type_):
+    """The converter for a column type and the value types it leaves
+    unchanged (None: every type but str)."""
+    # DateTime before Date: some dialect types derive from both.
+    if isinstance(type_, sqltypes.DateTime):
+        return to_datetime, {datetime}
+    if isinstance(type_, sqltypes.Date):
+        return to_date, {date}
+    if isinstance(type_, sqltypes.Time):
+        return to_time, {time}
+    if isinstance(type_, sqltypes.Boolean):
+        return to_bool, {bool}
+    if isinstance(type_, sqltypes.Integer):
+        return to_int, None
+    if isinstance(type_, sqltypes.Numeric):
+        return (to_decimal if type_.asdecimal else to_float), None
+    return None, None
+
+
+def _compile(column):
+    func, accepted = type_converter(column.type)
+    if func is None:
+        return None
+    label = '{}.{}'.format(column.table.name, column.name) \
+        if hasattr(column.table, 'name') else column.name
+
+    def convert(value):
+        if value is None:
+            return None
+        # Empty CSV fields of non-string columns mean NULL.
+        if value == '' and isinstance(value, str):
+            return None
+        try:
+            return func(value)
+        except (ValueError, TypeError, OverflowError) as e:
+            msg = 'Cannot convert {!r} for column {} ({}): {}'.format(
+                value, label, column.type, e)
+            raise ValueError(msg) from e
+
+    if accepted is None:
+        def skip(types):
+            return str not in types
+    else:
+        accepted = frozenset(accepted | {type(None)})
+
+        def skip(types):
+            return types <= accepted
+    convert.skip = skip
+    return convert
+
+
+def column_converter(column):
+    """The input converter of a column, or None for types taken as-is."""
+    if 'dblink_converter' not in column.info:
+        column.info['dblink_converter'] = _compile(column)
+    return column.info['dblink_converter']
+
+
+class Coercer:
+    """Input converters of one table, compiled once from its column types.
+
+    Strings are parsed into the Python type of the column (ISO-8601 fast
+    paths for temporal types, dateutil otherwise); values of the right type
+    pass through unchanged.
+    """
+
+    def __init__(self, table):
+        converters = ((c.name, column_converter(c)) for c in table.columns)
+        self.converters = {name: f for name, f in converters if f is not None}
+
+    def row(self, item):
+        converters = self.converters
+        return {k: converters[k](v) if k in converters else v
+                for k, v in item.items()}
+
+    def rows(self, rows):
+        # Only columns holding values of another type are converted, most
+        # batches are taken as they are.
+        converters = [(name, convert)
+                      for name, convert in self.converters.items()
+                      if not convert.skip({type(row.get(name))
+                                           for row in rows})]
+        if not converters:
+            return rows
+        result = []
+        for item in rows:
+            row = dict(item)
+            for name, convert in converters:
+                if name in row:
+                    row[name] = convert(row[name])
+            result.append(row)
+        return result
+
+    def value(self, name, value):
+        convert = self.converters.get(name)
+        return value if convert is None else convert(value)
+
+
+def coercer_for(table):
+    if 'dblink_coercer' not in table.info:
+        table.info['dblink_coercer'] = Coercer(table)
+    return table.info['dblink_coercer']
@@ -0,0 +1,96 @@
+import array
+import collections
+from sqlalchemy.sql import sqltypes
+from dblink.utils import column_labels
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# kind -> (numpy dtype, array.array typecode)
+KINDS = {
+    'bool': ('bool', 'b'),
+    'int': ('int64', 'q'),
+    'float': ('float64', 'd'),
+    'object': (object, None),
+}
+
+
+def column_kind(type_):
+    if isinstance(type_, sqltypes.Boolean):
+        return 'bool'
+    if isinstance(type_, sqltypes.Integer):
+        return 'int'
+    if isinstance(type_, (sqltypes.Float, sqltypes.Numeric)):
+        return 'float'
+    return 'object'
+
+
+class ColumnBuffer:
+    def __init__(self, kind, use_numpy):
+        self.kind = kind
+        self.use_numpy = use_numpy
+        self.parts = []
+
+    def extend(self, values):
+        if self.kind == 'float':
+            values = [float('nan') if v is None else float(v)
+                      for v in values]
+        elif self.kind in {'int', 'bool'} and None in values:
+            # NULLs do not fit integer storage, widen like pandas does.
+            self.kind = 'float' if self.kind == 'int' else 'object'
+            self.parts = [self._convert(p) for p in self.parts]
+            return self.extend(values)
+        self.parts.append(self._build(values))
+
+    def _build(self, values):
+        dtype, typecode = KINDS[self.kind]
+        if self.use_numpy:
+            return numpy.array(values, dtype=dtype)
+        if typecode is None:
+            return list(values)
+        return array.array(typecode, values)
+
+    def _convert(self, part):
+        if self.kind == 'float':
+            return self._build([float(v) for v in part])
+        return self._build(list(part))
+
+    def result(self):
+        if self.use_numpy:
+            if not self.parts:
+                return numpy.array([], dtype=KINDS[self.kind][0])
+            return numpy.concatenate(self.parts)
+        result = self._build([])
+        for part in self.parts:
+            result.extend(part)
+        return result
+
+
+def fetch_columns(connection, statement, descriptions, batch_size):
+    names = column_labels(descriptions)
+    dialect = connection.dialect
+    processors = [d['type'].result_processor(dialect, None)
+                  for d in descriptions]
+    buffers = collections.OrderedDict(
+        (name, ColumnBuffer(column_kind(d['type']), numpy is not None))
+        for name, d in zip(names, descriptions))
+
+    result = connection.execution_options(stream_results=True) \
+        .execute(statement)
+    try:
+        cursor = result.cursor
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for buffer, processor, values in zip(
+                    buffers.values(), processors, zip(*rows)):
+                if processor is not None:
+                    values = [processor(v) for v in values]
+                buffer.extend(values)
+    finally:
+        result.close()
+    return collections.OrderedDict(
+        (name, buffer.result()) for name, buffer in buffers.items())
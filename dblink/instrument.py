@@ -0,0 +1,164 @@
+import collections
+import hashlib
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from sqlalchemy import event
+
+slow_logger = logging.getLogger('DBLink.slow')
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMS = re.compile(r'%\(\w+\)s|:\w+|\$\d+|%s|\?')
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_ROWS = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+_SPACES = re.compile(r'\s+')
+_TEMP_TABLES = re.compile(r'dblink_tmp_[0-9a-f]{16}')
+
+
+def normalize_statement(statement):
+    statement = _TEMP_TABLES.sub('dblink_tmp', statement)
+    statement = _LITERALS.sub('?', statement)
+    statement = _PARAMS.sub('?', statement)
+    statement = _LISTS.sub('(...)', statement)
+    statement = _ROWS.sub('(...)', statement)
+    return _SPACES.sub(' ', statement).strip()
+
+
+def fingerprint(statement):
+    digest = hashlib.sha1(statement.encode('utf8'))
+    return digest.hexdigest()[:16]
+
+
+class OperationEvent:
+    def __init__(self, operation, table):
+        self.operation = operation
+        self.table = table
+        self.elapsed = None
+        self.rows = None
+        self.batches = 0
+        self.statements = 0
+        self.statement = None
+        self.fingerprint = None
+        self.commit_time = None
+        self.error = None
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    def __repr__(self):
+        return '<OperationEvent {} on {}: {:.3f}s, {} rows>'.format(
+            self.operation, self.table, self.elapsed or 0, self.rows)
+
+
+class LoggingSink:
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('DBLink.metrics')
+        self.level = level
+
+    def __call__(self, event):
+        self.logger.log(self.level, '%s', event.as_dict())
+
+
+class MemorySink:
+    def __init__(self, maxlen=1000):
+        self.events = collections.deque(maxlen=maxlen)
+        self.totals = collections.defaultdict(
+            lambda: {'count': 0, 'elapsed': 0.0, 'rows': 0,
+                     'statement': None})
+        self.__lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.__lock:
+            self.events.append(event)
+            key = (event.operation, event.table, event.fingerprint)
+            total = self.totals[key]
+            total['count'] += 1
+            total['elapsed'] += event.elapsed
+            total['rows'] += event.rows or 0
+            total['statement'] = event.statement
+
+    def top(self, n=10):
+        with self.__lock:
+            items = sorted(self.totals.items(),
+                           key=lambda item: item[1]['elapsed'], reverse=True)
+        return [dict(zip(('operation', 'table', 'fingerprint'), key), **value)
+                for key, value in items[:n]]
+
+
+class Instrumentation:
+    def __init__(self, sinks=(), slow_threshold=None):
+        self.sinks = list(sinks)
+        self.slow_threshold = slow_threshold
+        self.__local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.sinks) or self.slow_threshold is not None
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+
+    def current(self):
+        stack = getattr(self.__local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def operation(self, name, table):
+        if not self.enabled:
+            yield None
+            return
+        record = OperationEvent(name, table)
+        stack = self.__local.__dict__.setdefault('stack', [])
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record.error = repr(e)
+            raise
+        finally:
+            record.elapsed = time.perf_counter() - start
+            stack.pop()
+            self.emit(record)
+
+    def emit(self, record):
+        for sink in self.sinks:
+            sink(record)
+        if self.slow_threshold is not None and \
+                record.elapsed >= self.slow_threshold:
+            slow_logger.warning(
+                'Slow %s on %s: %.3fs, rows=%s, batches=%s, fingerprint=%s, '
+                'statement=%s', record.operation, record.table,
+                record.elapsed, record.rows, record.batches,
+                record.fingerprint, (record.statement or '')[:300])
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        record = self.current()
+        if record is None:
+            return
+        record.statements += 1
+        if record.statement is None:
+            record.statement = normalize_statement(statement)
+            record.fingerprint = fingerprint(record.statement)
+
+
+def instrumented(name, rows=None):
+    def decorate(f):
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            instrumentation = self.db.instrumentation
+            if not instrumentation.enabled:
+                return f(self, *args, **kwargs)
+            with instrumentation.operation(name, self.table_label) as record:
+                result = f(self, *args, **kwargs)
+                record.rows = result if rows is None else rows(result)
+                return result
+        return wrapper
+    return decorate
@@ -0,0 +1,192 @@
+import io
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, time
+from decimal import Decimal
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import sqltypes
+from dblink.exceptions import UnexpectedParam
+from dblink.utils import chunked, max_bind_params
+
+LOADERS = dict()
+DEFAULT_LOADERS = {'postgresql': 'copy', 'sqlite': 'sqlite',
+                   'mysql': 'values'}
+COPY_SCALARS = (str, int, float, Decimal, uuid.UUID)
+
+
+def register_loader(cls):
+    LOADERS[cls.name] = cls
+    return cls
+
+
+def get_loader(strategy, dialect):
+    if isinstance(strategy, Loader):
+        return strategy
+    if strategy is None:
+        strategy = DEFAULT_LOADERS.get(dialect.name, 'executemany')
+        if strategy == 'copy' and dialect.driver != 'psycopg2':
+            strategy = 'values'
+    if strategy not in LOADERS:
+        msg = 'Unknown bulk load strategy {}'.format(strategy)
+        raise UnexpectedParam(msg)
+    return LOADERS[strategy]()
+
+
+class Loader:
+    name = None
+
+    def load(self, table, session, rows):
+        raise NotImplementedError
+
+
+@register_loader
+class ExecutemanyLoader(Loader):
+    name = 'executemany'
+
+    def load(self, table, session, rows):
+        session.execute(table.sal_table.insert(), rows)
+
+
+@register_loader
+class ValuesLoader(Loader):
+    """Multi-row INSERT ... VALUES sized to the dialect's bind limit."""
+
+    name = 'values'
+
+    def load(self, table, session, rows):
+        columns = list(rows[0])
+        size = max(1, max_bind_params(session.bind.dialect) // len(columns))
+        for chunk in chunked(rows, size):
+            values = [{c: row[c] for c in columns} for row in chunk]
+            session.execute(table.sal_table.insert().values(values))
+
+
+def _processed_rows(table, dialect, columns, rows, raw_types=()):
+    processors = [None if isinstance(table.c[c].type, raw_types) else
+                  table.c[c].type.bind_processor(dialect) for c in columns]
+    if not any(processors):
+        return [tuple(row[c] for c in columns) for row in rows]
+    return [tuple(row[c] if p is None else p(row[c])
+                  for c, p in zip(columns, processors)) for row in rows]
+
+
+@contextmanager
+def driver_errors(dialect, statement, rows):
+    """Raise errors of raw cursor calls as SQLAlchemy's DBAPIError
+    subclasses, like statements run through the session."""
+    try:
+        yield
+    except dialect.dbapi.Error as e:
+        raise DBAPIError.instance(statement, rows, e, dialect.dbapi.Error,
+                                  dialect=dialect) from e
+
+
+@register_loader
+class SQLiteLoader(Loader):
+    """Prepared executemany on the raw sqlite3 cursor.
+
+    With bulk_pragmas the connection is switched to a bulk-load profile
+    (no fsync, in-memory temp store, bigger page cache); this stays in
+    effect for the life of the connection.
+    """
+
+    name = 'sqlite'
+    BULK_PRAGMAS = (('synchronous', 'OFF'), ('temp_store', 'MEMORY'),
+                    ('cache_size', '-65536'))
+
+    def __init__(self, bulk_pragmas=False):
+        self.bulk_pragmas = bulk_pragmas
+
+    def load(self, table, session, rows):
+        connection = session.connection()
+        dbapi_connection = connection.connection
+        if self.bulk_pragmas and 'dblink_bulk_pragmas' not in \
+                connection.info and not dbapi_connection.in_transaction:
+            for pragma, value in self.BULK_PRAGMAS:
+                dbapi_connection.execute(
+                    'PRAGMA {} = {}'.format(pragma, value))
+            connection.info['dblink_bulk_pragmas'] = True
+
+        dialect = connection.dialect
+        compiled = table.sal_table.insert().compile(
+            dialect=dialect, column_keys=list(rows[0]))
+        columns = compiled.positiontup
+        cursor = dbapi_connection.cursor()
+        try:
+            with driver_errors(dialect, compiled.string, rows):
+                cursor.executemany(
+                    compiled.string,
+                    _processed_rows(table, dialect, columns, rows))
+        finally:
+            cursor.close()
+
+
+def _copy_value(value):
+    """The PostgreSQL text input of a bound value, TypeError for values
+    without a known one."""
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        return _copy_array(value)
+    if isinstance(value, COPY_SCALARS):
+        return str(value)
+    raise TypeError('No COPY text for {!r}'.format(value))
+
+
+def _copy_array(values):
+    items = []
+    for value in values:
+        if value is None:
+            items.append('NULL')
+        elif isinstance(value, (list, tuple)):
+            items.append(_copy_array(value))
+        else:
+            items.append('"{}"'.format(_copy_value(value)
+                                       .replace('\\', '\\\\')
+                                       .replace('"', '\\"')))
+    return '{{{}}}'.format(','.join(items))
+
+
+def _copy_text(value):
+    if value is None:
+        return '\\N'
+    return _copy_value(value).replace('\\', '\\\\') \
+        .replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+@register_loader
+class CopyLoader(Loader):
+    """PostgreSQL COPY FROM STDIN through psycopg2's copy_expert."""
+
+    name = 'copy'
+
+    def load(self, table, session, rows):
+        connection = session.connection()
+        dialect = connection.dialect
+        preparer = dialect.identifier_preparer
+        columns = list(rows[0])
+        buffer = io.StringIO()
+        # bytes are written in bytea hex format, not as driver objects
+        processed = _processed_rows(table, dialect, columns, rows,
+                                    raw_types=sqltypes.LargeBinary)
+        try:
+            for row in processed:
+                buffer.write('\t'.join(_copy_text(v) for v in row))
+                buffer.write('\n')
+        except TypeError:
+            # e.g. hstore dicts or intervals, left to the driver
+            return ValuesLoader().load(table, session, rows)
+        buffer.seek(0)
+        sql = 'COPY {} ({}) FROM STDIN'.format(
+            preparer.format_table(table.sal_table),
+            ', '.join(preparer.quote(c) for c in columns))
+        cursor = connection.connection.cursor()
+        try:
+            with driver_errors(dialect, sql, processed):
+                cursor.copy_expert(sql, buffer)
+        finally:
+            cursor.close()
@@ -0,0 +1,168 @@
+import collections
+import queue
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait,
+)
+from dblink.utils import chunked
+
+_END = object()
+
+
+def parallel_bulk(table, method, data, workers=4, batch_size=None,
+                  progress=None, **kwargs):
+    operation = getattr(table, method)
+    batch_size = batch_size or table.BATCH_SIZE
+    counter = {'batches': 0, 'total': 0}
+
+    def run(chunk):
+        try:
+            return operation(chunk, batch_size=batch_size, **kwargs)
+        finally:
+            table.db.remove_session()
+
+    def collect(futures):
+        for future in futures:
+            rows = future.result()
+            counter['batches'] += 1
+            counter['total'] += rows
+            if progress is not None:
+                progress(counter['batches'], rows, counter['total'])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for chunk in chunked(data, batch_size):
+            pending.add(executor.submit(run, chunk))
+            # Keep at most two batches per worker in memory.
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(wait(pending).done)
+    return counter['total']
+
+
+def split_range(low, high, count):
+    """Ascending bounds cutting [low, high] into count even ranges, for
+    numbers, dates and datetimes."""
+    span = high - low
+    if isinstance(span, int):
+        bounds = (low + (span + 1) * i // count for i in range(1, count))
+    else:
+        bounds = (low + span * i / count for i in range(1, count))
+    return sorted({b for b in bounds if low < b <= high})
+
+
+def _put(queue_, item, stop):
+    while not stop.is_set():
+        try:
+            queue_.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def partition_batches(partitions, workers=4, ordered=False,
+                      batch_size=None, transform=None):
+    """Run every partition query on its own thread (and session) and yield
+    their row batches as they arrive, or partition by partition with
+    ordered."""
+    if not partitions:
+        return
+    db = partitions[0].db
+    batch_size = batch_size or partitions[0].STREAM_BATCH_SIZE
+    stop = threading.Event()
+    # Bounded queues keep at most a few batches per worker in memory.
+    if ordered:
+        queues = [queue.Queue(maxsize=2) for _ in partitions]
+    else:
+        queues = [queue.Queue(maxsize=workers * 2)] * len(partitions)
+
+    def produce(query, queue_):
+        try:
+            for batch in chunked(query.stream(batch_size), batch_size):
+                if transform is not None:
+                    batch = [transform(row) for row in batch]
+                if not _put(queue_, batch, stop):
+                    return
+            _put(queue_, _END, stop)
+        except Exception as e:
+            _put(queue_, e, stop)
+        finally:
+            # closes the cursor of an abandoned stream as well
+            db.remove_session()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        # Partitions start in order, so the one an ordered consumer waits
+        # for is always running.
+        for query, queue_ in zip(partitions, queues):
+            executor.submit(produce, query, queue_)
+        pending = len(partitions)
+        index = 0
+        while pending:
+            item = queues[index].get()
+            if item is _END:
+                pending -= 1
+                index += 1 if ordered else 0
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+
+def parallel_iter(query, workers=4, partition_by=None, partitions=None,
+                  method='minmax', ordered=False, batch_size=None):
+    parts = query.partitions(partitions or workers * 4, partition_by,
+                             method, ordered)
+    for batch in partition_batches(parts, workers, ordered, batch_size):
+        for row in batch:
+            yield row
+
+
+def _apply(fn, rows):
+    return [fn(row) for row in rows]
+
+
+def parallel_map(query, fn, workers=4, partition_by=None, partitions=None,
+                 method='minmax', ordered=False, batch_size=None,
+                 processes=None):
+    parts = query.partitions(partitions or workers * 4, partition_by,
+                             method, ordered)
+    if not processes:
+        for batch in partition_batches(parts, workers, ordered, batch_size,
+                                       transform=fn):
+            for result in batch:
+                yield result
+        return
+
+    # Rows are fetched on threads and mapped in batches by the process
+    # pool, fn and the rows must be picklable.
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = collections.deque()
+        batches = partition_batches(parts, workers, ordered, batch_size)
+        try:
+            for batch in batches:
+                pending.append(executor.submit(_apply, fn, batch))
+                while len(pending) >= processes * 2:
+                    for result in _next_done(pending, ordered):
+                        yield result
+            while pending:
+                for result in _next_done(pending, ordered):
+                    yield result
+        finally:
+            batches.close()
+            for future in pending:
+                future.cancel()
+
+
+def _next_done(pending, ordered):
+    if ordered:
+        return pending.popleft().result()
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    future = next(iter(done))
+    pending.remove(future)
+    return future.result()
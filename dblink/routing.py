@@ -0,0 +1,175 @@
+import itertools
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.selectable import Select, CompoundSelect
+from dblink.exceptions import UnexpectedParam
+
+ROUTING_POLICIES = ('round_robin', 'least_connections')
+
+
+class Replica:
+    """A read replica engine, its checked out connections and health."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.in_use = 0
+        self.down_until = None
+        self.failures = 0
+        self.__lock = threading.Lock()
+        event.listen(engine, 'checkout', self._checkout)
+        event.listen(engine, 'checkin', self._checkin)
+
+    def _checkout(self, dbapi_connection, record, proxy):
+        with self.__lock:
+            self.in_use += 1
+
+    def _checkin(self, dbapi_connection, record):
+        with self.__lock:
+            self.in_use = max(0, self.in_use - 1)
+
+    @property
+    def healthy(self):
+        return self.down_until is None or time.monotonic() >= self.down_until
+
+    def mark_down(self, retry_interval):
+        self.failures += 1
+        self.down_until = time.monotonic() + retry_interval
+
+    def mark_up(self):
+        self.down_until = None
+
+    def status(self):
+        return {'url': repr(self.engine.url), 'healthy': self.healthy,
+                'in_use': self.in_use, 'failures': self.failures}
+
+
+class ReplicaRouter:
+    """Picks the replica of a session transaction.
+
+    Replicas whose connection failed (pool pre-ping included) are skipped
+    for retry_interval seconds; without a healthy replica reads go to the
+    primary.
+    """
+
+    def __init__(self, primary, replicas, policy='round_robin',
+                 retry_interval=30, read_your_writes=0):
+        if policy not in ROUTING_POLICIES:
+            msg = 'Unknown routing policy {}'.format(policy)
+            raise UnexpectedParam(msg)
+        self.primary = primary
+        self.replicas = [Replica(engine) for engine in replicas]
+        self.policy = policy
+        self.retry_interval = retry_interval
+        self.read_your_writes = read_your_writes
+        self.__counter = itertools.count()
+        self.__lock = threading.Lock()
+
+    def replica_for(self, engine):
+        for replica in self.replicas:
+            if replica.engine is engine:
+                return replica
+        return None
+
+    def choose(self):
+        healthy = [r for r in self.replicas if r.healthy]
+        if not healthy:
+            return None
+        if self.policy == 'least_connections':
+            return min(healthy, key=lambda r: r.in_use)
+        with self.__lock:
+            index = next(self.__counter)
+        return healthy[index % len(healthy)]
+
+    def status(self):
+        return [replica.status() for replica in self.replicas]
+
+
+def is_read(clause):
+    return isinstance(clause, (Select, CompoundSelect))
+
+
+class RoutingSession(Session):
+    """Session sending SELECTs to a replica and everything else to the
+    primary.
+
+    The replica is chosen once per transaction, so staged temporary tables
+    and the reads using them share a connection; release_replica() ends a
+    transaction that only read from one. Reads go to the primary as well
+    while the session is pinned (Database.primary()), after a write in the
+    same transaction, and for read_your_writes seconds after such a
+    transaction ended.
+    """
+
+    def __init__(self, router=None, **kwargs):
+        super().__init__(**kwargs)
+        self.router = router
+        event.listen(self, 'after_transaction_end', self._transaction_end)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.router is None or not self.router.replicas:
+            return super().get_bind(mapper, clause)
+        if not is_read(clause) or self._reads_primary():
+            if not is_read(clause):
+                self.info['dblink_wrote'] = True
+            self.info['dblink_bound_primary'] = True
+            return self.router.primary
+        replica = self.info.get('dblink_replica')
+        if replica is None:
+            replica = self.info['dblink_replica'] = self.router.choose()
+        if replica is None:
+            self.info['dblink_bound_primary'] = True
+            return self.router.primary
+        return replica.engine
+
+    def release_replica(self):
+        """End the transaction if it only read from a replica. Its
+        connection goes back to the pool and the next read picks (and
+        pre-pings) a replica again."""
+        info = self.info
+        if info.get('dblink_replica') is not None and \
+                not info.get('dblink_bound_primary') and \
+                not info.get('dblink_primary') and \
+                not info.get('dblink_streams'):
+            self.rollback()
+
+    def _reads_primary(self):
+        info = self.info
+        if info.get('dblink_primary') or info.get('dblink_wrote'):
+            return True
+        wrote_at = info.get('dblink_wrote_at')
+        return wrote_at is not None and \
+            time.monotonic() - wrote_at < self.router.read_your_writes
+
+    def _connection_for_bind(self, engine, execution_options=None, **kw):
+        replica = None if self.router is None else \
+            self.router.replica_for(engine)
+        if replica is None:
+            return super()._connection_for_bind(
+                engine, execution_options, **kw)
+        try:
+            connection = super()._connection_for_bind(
+                engine, execution_options, **kw)
+        except DBAPIError:
+            # Only connecting (and its pre-ping) happens here, the failure
+            # is the replica's: fail over to another one or the primary.
+            replica.mark_down(self.router.retry_interval)
+            self.info['dblink_replica'] = self.router.choose()
+            fallback = self.info['dblink_replica']
+            if fallback is None:
+                self.info['dblink_bound_primary'] = True
+            return self._connection_for_bind(
+                self.router.primary if fallback is None else fallback.engine,
+                execution_options, **kw)
+        replica.mark_up()
+        return connection
+
+    def _transaction_end(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        self.info.pop('dblink_replica', None)
+        self.info.pop('dblink_bound_primary', None)
+        if self.info.pop('dblink_wrote', False):
+            self.info['dblink_wrote_at'] = time.monotonic()
@@ -0,0 +1,131 @@
+import collections
+import hashlib
+import os
+import pickle
+import tempfile
+import sqlalchemy as sal
+from sqlalchemy.exc import NoReferencedTableError
+
+CACHE_VERSION = 1
+
+_FINGERPRINT_QUERIES = {
+    'sqlite': [
+        "SELECT type, name, tbl_name, sql FROM sqlite_master "
+        "ORDER BY type, name",
+    ],
+    'postgresql': [
+        "SELECT table_name, column_name, data_type, is_nullable, "
+        "column_default, ordinal_position FROM information_schema.columns "
+        "WHERE table_schema = current_schema() "
+        "ORDER BY table_name, ordinal_position",
+        "SELECT tablename, indexname, indexdef FROM pg_indexes "
+        "WHERE schemaname = current_schema() ORDER BY tablename, indexname",
+        "SELECT conrelid::regclass::text, conname, "
+        "pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE connamespace = current_schema()::regnamespace "
+        "ORDER BY 1, 2",
+    ],
+    'mysql': [
+        "SELECT table_name, column_name, column_type, is_nullable, "
+        "column_default, ordinal_position FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() "
+        "ORDER BY table_name, ordinal_position",
+        "SELECT table_name, index_name, column_name, seq_in_index, "
+        "non_unique FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() "
+        "ORDER BY table_name, index_name, seq_in_index",
+        "SELECT table_name, constraint_name, column_name, "
+        "referenced_table_name, referenced_column_name "
+        "FROM information_schema.key_column_usage "
+        "WHERE table_schema = DATABASE() "
+        "ORDER BY table_name, constraint_name, ordinal_position",
+    ],
+}
+
+
+def schema_fingerprint(engine):
+    queries = _FINGERPRINT_QUERIES.get(engine.dialect.name)
+    if queries is None:
+        return None
+    digest = hashlib.sha1()
+    with engine.connect() as connection:
+        for query in queries:
+            for row in connection.execute(sal.text(query)):
+                digest.update(repr(tuple(row)).encode('utf8'))
+    return digest.hexdigest()
+
+
+def load_metadata(path, fingerprint, names=None):
+    try:
+        with open(path, 'rb') as fh:
+            cache = pickle.load(fh)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError):
+        return None
+    if not isinstance(cache, dict) or \
+            cache.get('version') != CACHE_VERSION or \
+            cache.get('fingerprint') != fingerprint:
+        return None
+    metadata = cache['metadata']
+    if names is None:
+        complete = cache['names'] is None
+    else:
+        complete = set(names) <= set(metadata.tables)
+    return metadata if complete else None
+
+
+def dump_metadata(path, fingerprint, metadata, names=None):
+    cache = {'version': CACHE_VERSION, 'fingerprint': fingerprint,
+             'names': None if names is None else sorted(names),
+             'metadata': metadata}
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(cache, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class JoinGraph:
+    def __init__(self, metadata):
+        self.size = len(metadata.tables)
+        self.__edges = collections.defaultdict(list)
+        self.__paths = dict()
+        for table in metadata.tables.values():
+            for constraint in table.foreign_key_constraints:
+                try:
+                    remote = constraint.referred_table
+                    onclause = sal.and_(*[e.parent == e.column
+                                          for e in constraint.elements])
+                except NoReferencedTableError:
+                    continue
+                self.__edges[table.name].append((remote, onclause))
+                self.__edges[remote.name].append((table, onclause))
+
+    def path(self, sources, target):
+        key = (frozenset(sources), target)
+        if key not in self.__paths:
+            self.__paths[key] = self._search(key[0], target)
+        return self.__paths[key]
+
+    def _search(self, sources, target):
+        previous = {name: None for name in sources}
+        queue = collections.deque(sources)
+        while queue:
+            name = queue.popleft()
+            if name == target:
+                break
+            for table, onclause in self.__edges[name]:
+                if table.name not in previous:
+                    previous[table.name] = (name, table, onclause)
+                    queue.append(table.name)
+        if target not in previous:
+            return None
+        path, name = [], target
+        while previous[name] is not None:
+            name, table, onclause = previous[name]
+            path.append((table, onclause))
+        return path[::-1]
@@ -0,0 +1,170 @@
+import collections
+import uuid
+import weakref
+import sqlalchemy as sal
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Update
+from dblink.utils import chunked, sqlite_version, supports_row_values
+
+MAX_STAGED_TABLES = 16
+STAGE_BATCH_SIZE = 1000
+SQLITE_UPDATE_FROM_VERSION = (3, 33, 0)
+
+
+def temporary_table(*columns):
+    name = 'dblink_tmp_{}'.format(uuid.uuid4().hex[:16])
+    return sal.Table(name, sal.MetaData(), *columns, prefixes=['TEMPORARY'])
+
+
+def _staged_registry(connection):
+    return connection.info.setdefault(
+        'dblink_staged', collections.OrderedDict())
+
+
+class StagedValues:
+    """Values of a huge IN clause, kept in a temporary table.
+
+    The table is created lazily on the connection that runs the query, so
+    the owning Query can be executed any number of times, on any pooled
+    connection. Each connection keeps at most MAX_STAGED_TABLES of them.
+    Its rows belong to the transaction that loaded them (a rollback may
+    keep the table but drop the rows), so every new transaction reloads
+    them.
+    """
+
+    def __init__(self, column, values):
+        self.values = [v for v in dict.fromkeys(values) if v is not None]
+        self.table = temporary_table(
+            sal.Column('value', column.type, primary_key=True))
+
+    def select(self):
+        return sal.select([self.table.c.value])
+
+    def ensure(self, connection, transaction):
+        registry = _staged_registry(connection)
+        name = self.table.name
+        if name in registry:
+            if registry[name][1]() is transaction:
+                registry.move_to_end(name)
+                return
+            # Loaded by an earlier transaction, the table may be gone
+            # (PostgreSQL) or emptied (SQLite, MySQL) by its rollback.
+            del registry[name]
+            self.table.drop(bind=connection, checkfirst=True)
+        self.table.create(bind=connection)
+        for chunk in chunked(self.values, STAGE_BATCH_SIZE):
+            connection.execute(self.table.insert(),
+                               [{'value': v} for v in chunk])
+        registry[name] = (self.table, weakref.ref(transaction))
+        while len(registry) > MAX_STAGED_TABLES:
+            _, (table, _) = registry.popitem(last=False)
+            table.drop(bind=connection, checkfirst=True)
+
+
+class StagedRows:
+    """Rows of a set-based write or delete, in a temporary table.
+
+    The table is created on first load and lives on the connection of the
+    running transaction; it is emptied between batches and dropped by
+    drop(). It exposes sal_table and c, so any bulk loader can fill it.
+    """
+
+    def __init__(self, target, key_fields, fields):
+        self.target = target
+        self.key_fields = sorted(key_fields)
+        self.fields = sorted(set(fields) - set(key_fields))
+        self.sal_table = temporary_table(*[
+            sal.Column(f, target.c[f].type, primary_key=f in key_fields)
+            for f in self.key_fields + self.fields])
+        self.connection = None
+
+    @property
+    def c(self):
+        return self.sal_table.c
+
+    def load(self, session, rows, loader):
+        # The last row of a key wins, like consecutive per-row statements.
+        # NULL keys can never match and would violate the primary key.
+        columns = self.key_fields + self.fields
+        unique = dict()
+        for row in rows:
+            key = tuple(row[f] for f in self.key_fields)
+            if None not in key:
+                unique[key] = {c: row[c] for c in columns}
+        connection = session.connection()
+        if self.connection is None:
+            self.sal_table.create(bind=connection)
+            self.connection = connection
+        else:
+            connection.execute(self.sal_table.delete())
+        if unique:
+            loader.load(self, session, list(unique.values()))
+        return len(unique)
+
+    def _member_condition(self, dialect):
+        # Lets SQLite drive the statement from the staged keys instead of
+        # scanning the whole target table.
+        columns = [self.target.c[k] for k in self.key_fields]
+        keys = sal.select([self.c[k] for k in self.key_fields])
+        if len(columns) == 1:
+            return columns[0].in_(keys)
+        if supports_row_values(dialect):
+            return sal.tuple_(*columns).in_(keys)
+        return None
+
+    def update_statement(self, dialect):
+        target, c = self.target, self.c
+        cond = sal.and_(*[target.c[k] == c[k] for k in self.key_fields])
+        if dialect.name in {'postgresql', 'mysql'}:
+            return target.update().where(cond) \
+                .values({f: c[f] for f in self.fields})
+        member = self._member_condition(dialect)
+        if dialect.name == 'sqlite' and \
+                sqlite_version(dialect) >= SQLITE_UPDATE_FROM_VERSION:
+            return SQLiteUpdateFrom(self, sal.and_(cond, member))
+        lookups = {f: sal.select([c[f]]).where(cond).as_scalar()
+                   for f in self.fields}
+        if member is None:
+            member = sal.exists().where(cond)
+        return target.update().where(member).values(lookups)
+
+    def delete_statement(self, dialect):
+        member = self._member_condition(dialect)
+        if member is None:
+            member = sal.exists().where(sal.and_(
+                *[self.target.c[k] == self.c[k] for k in self.key_fields]))
+        return self.target.delete().where(member)
+
+    def drop(self, failed=False):
+        # After a failed statement PostgreSQL refuses the DROP until the
+        # rollback, which removes the table anyway; its error must not
+        # replace the original one.
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        try:
+            self.sal_table.drop(bind=connection)
+        except sal.exc.SQLAlchemyError:
+            if not failed:
+                raise
+
+
+class SQLiteUpdateFrom(Update):
+    """UPDATE ... FROM for SQLite, which SQLAlchemy 1.3 lacks."""
+
+    def __init__(self, staged, whereclause):
+        super().__init__(staged.target)
+        self.staged = staged
+        self.condition = whereclause
+
+
+@compiles(SQLiteUpdateFrom, 'sqlite')
+def _compile_sqlite_update_from(element, compiler, **kw):
+    quote = compiler.preparer.quote
+    target = compiler.preparer.format_table(element.table)
+    source = compiler.preparer.format_table(element.staged.sal_table)
+    assignments = ', '.join('{0} = {1}.{0}'.format(quote(f), source)
+                            for f in element.staged.fields)
+    return 'UPDATE {} SET {} FROM {} WHERE {}'.format(
+        target, assignments, source,
+        compiler.process(element.condition, **kw))
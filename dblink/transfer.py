@@ -0,0 +1,132 @@
+import csv
+import gzip
+import io
+import json
+import os
+from contextlib import contextmanager
+from datetime import date, time
+from decimal import Decimal
+from dblink.exceptions import UnexpectedParam
+
+FORMATS = ('csv', 'ndjson')
+# the NULL of CSV files, as in PostgreSQL's COPY
+CSV_NULL = '\\N'
+COMPRESSIONS = (None, 'gzip', 'infer')
+GZIP_MAGIC = b'\x1f\x8b'
+# os.PathLike is new in Python 3.6
+PATH_TYPES = (str, os.PathLike) if hasattr(os, 'PathLike') else (str,)
+
+
+def check_format(format):
+    if format not in FORMATS:
+        msg = 'Unknown format {}, use one of {}'.format(format, FORMATS)
+        raise UnexpectedParam(msg)
+
+
+def _is_gzip(fileobj, mode):
+    name = getattr(fileobj, 'name', None)
+    if isinstance(name, str) and name.endswith('.gz'):
+        return True
+    if mode != 'r':
+        return False
+    if hasattr(fileobj, 'peek'):
+        return fileobj.peek(2)[:2] == GZIP_MAGIC
+    if fileobj.seekable():
+        position = fileobj.tell()
+        head = fileobj.read(2)
+        fileobj.seek(position)
+        return head == GZIP_MAGIC
+    return False
+
+
+@contextmanager
+def open_text(target, mode, compression='infer'):
+    """A text stream ('r' or 'w') over a path or a file object.
+
+    gzip is used when asked for, or with 'infer' for .gz names and for
+    binary input starting with the gzip magic. Files passed in are left
+    open.
+    """
+    if compression not in COMPRESSIONS:
+        msg = 'Unknown compression {}'.format(compression)
+        raise UnexpectedParam(msg)
+    owned = []
+    if isinstance(target, PATH_TYPES):
+        target = open(target, mode + 'b')
+        owned.append(target)
+    try:
+        if isinstance(target, io.TextIOBase):
+            if compression == 'gzip':
+                raise UnexpectedParam('gzip needs a binary file')
+            yield target
+            return
+        if compression == 'gzip' or \
+                compression == 'infer' and _is_gzip(target, mode):
+            target = gzip.GzipFile(fileobj=target, mode=mode + 'b')
+            owned.append(target)
+        stream = io.TextIOWrapper(target, encoding='utf8', newline='')
+        try:
+            yield stream
+        finally:
+            if mode == 'w':
+                stream.flush()
+            stream.detach()
+    finally:
+        for fileobj in reversed(owned):
+            fileobj.close()
+
+
+def _csv_value(value, null):
+    if value is None:
+        return null
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return value
+
+
+def _json_default(value):
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        # as text, a float would lose digits
+        return str(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def write_rows(stream, fields, rows, format, null=CSV_NULL):
+    """Write rows as CSV with a header line or as NDJSON, return their
+    count. CSV writes NULL as null."""
+    check_format(format)
+    total = 0
+    if format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow([_csv_value(v, null) for v in row])
+            total += 1
+        return total
+    for row in rows:
+        stream.write(json.dumps(dict(zip(fields, row)),
+                                default=_json_default, ensure_ascii=False))
+        stream.write('\n')
+        total += 1
+    return total
+
+
+def read_rows(stream, format, null=CSV_NULL):
+    """Dicts of the rows of a CSV (with a header line) or NDJSON stream.
+
+    CSV values are strings, the bulk methods convert them to the column
+    types. Fields equal to null are NULL, and so are empty fields for
+    every type but strings.
+    """
+    check_format(format)
+    if format == 'csv':
+        for row in csv.DictReader(stream):
+            if null is not None:
+                row = {k: None if v == null else v for k, v in row.items()}
+            yield row
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
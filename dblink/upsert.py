@@ -0,0 +1,55 @@
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Insert
+from dblink.utils import sqlite_version
+
+SQLITE_UPSERT_VERSION = (3, 24, 0)
+
+
+class SQLiteInsert(Insert):
+    """INSERT ... ON CONFLICT for SQLite, which SQLAlchemy 1.3 lacks."""
+
+    def __init__(self, table, index_elements, update_fields, **kwargs):
+        super().__init__(table, **kwargs)
+        self.index_elements = list(index_elements)
+        self.update_fields = list(update_fields)
+
+
+@compiles(SQLiteInsert, 'sqlite')
+def _compile_sqlite_insert(element, compiler, **kw):
+    quote = compiler.preparer.quote
+    sql = compiler.visit_insert(element, **kw)
+    target = ', '.join(quote(f) for f in element.index_elements)
+    if not element.update_fields:
+        return '{} ON CONFLICT ({}) DO NOTHING'.format(sql, target)
+    assignments = ', '.join('{0} = excluded.{0}'.format(quote(f))
+                            for f in element.update_fields)
+    return '{} ON CONFLICT ({}) DO UPDATE SET {}'.format(
+        sql, target, assignments)
+
+
+def supports_upsert(engine):
+    name = engine.dialect.name
+    if name == 'sqlite':
+        return sqlite_version(engine.dialect) >= SQLITE_UPSERT_VERSION
+    return name in {'postgresql', 'mysql'}
+
+
+def upsert_statement(table, dialect, unique_fields, update_fields):
+    update_fields = [f for f in update_fields if f not in set(unique_fields)]
+    if dialect == 'sqlite':
+        return SQLiteInsert(table, unique_fields, update_fields)
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(table)
+        if not update_fields:
+            return stmt.on_conflict_do_nothing(index_elements=unique_fields)
+        return stmt.on_conflict_do_update(
+            index_elements=unique_fields,
+            set_={f: stmt.excluded[f] for f in update_fields})
+    if dialect == 'mysql':
+        stmt = mysql.insert(table)
+        # MySQL has no DO NOTHING, re-assigning a key column is a no-op.
+        fields = update_fields or list(unique_fields)[:1]
+        return stmt.on_duplicate_key_update(
+            **{f: stmt.inserted[f] for f in fields})
+    return None
@@ -0,0 +1,66 @@
+import collections
+import itertools
+import sqlite3
+from dblink.exceptions import DuplicateColumns
+
+_json_support = {}
+
+
+def chunked(iterable, size):
+    if size < 1:
+        raise ValueError('Chunk size must be positive')
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def sqlite_json_support(dialect):
+    dbapi = dialect.dbapi
+    if dbapi not in _json_support:
+        try:
+            dbapi.connect(':memory:').execute("SELECT json('[]')")
+        except dbapi.Error:
+            _json_support[dbapi] = False
+        else:
+            _json_support[dbapi] = True
+    return _json_support[dbapi]
+
+
+def sqlite_version(dialect):
+    return getattr(dialect.dbapi, 'sqlite_version_info',
+                   sqlite3.sqlite_version_info)
+
+
+def supports_row_values(dialect):
+    if dialect.name == 'sqlite':
+        return sqlite_version(dialect) >= (3, 15, 0)
+    return dialect.name in {'postgresql', 'mysql'}
+
+
+def max_bind_params(dialect):
+    if dialect.name == 'sqlite':
+        return 32766 if sqlite_version(dialect) >= (3, 32, 0) else 999
+    return {'postgresql': 32767, 'mysql': 65535,
+            'mssql': 2100, 'oracle': 65535}.get(dialect.name, 999)
+
+
+def column_labels(descriptions):
+    """Unique names of the columns of Query.column_descriptions. Names
+    that appear more than once, e.g. after a join, are qualified as
+    table_column."""
+    names = [d['name'] or 'column_{}'.format(i)
+             for i, d in enumerate(descriptions)]
+    counts = collections.Counter(names)
+    labels = []
+    for name, d in zip(names, descriptions):
+        table = getattr(d['expr'], 'table', None)
+        if counts[name] > 1 and getattr(table, 'name', None):
+            name = '{}_{}'.format(table.name, name)
+        labels.append(name)
+    if len(set(labels)) < len(labels):
+        msg = 'Ambiguous columns {}, label them'.format(labels)
+        raise DuplicateColumns(msg)
+    return labels
@@ -14,7 +14,8 @@ setup(
     license='MIT',
     keywords='sql orm dblink',
     test_suite="tests",
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks', 'benchmarks.*']),
+    extras_require={'numpy': ['numpy']},
     long_description=long_description,
     long_description_content_type="text/markdown",
     classifiers=[
@@ -26,6 +26,14 @@ class Address(Base):
     user = relationship("User", back_populates="addresses")
 
 
+class Message(Base):
+    __tablename__ = 'messages'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    subject = Column(String(50))
+    address_id = Column(Integer, ForeignKey('addresses.id'))
+
+
 class BirthInfo(Base):
     __tablename__ = 'birth_info'
 
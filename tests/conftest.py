@@ -0,0 +1,4 @@
+import sys
+
+# async generators need Python 3.6
+collect_ignore = ['test_aio.py'] if sys.version_info < (3, 6) else []
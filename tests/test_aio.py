@@ -0,0 +1,55 @@
+import asyncio
+import os
+import tempfile
+from unittest import TestCase
+from sqlalchemy import create_engine
+from dblink.aio import AsyncDatabase
+from tests import create_table
+
+
+class AsyncTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.url = 'sqlite:///' + os.path.join(self.tmp.name, 'db.sqlite')
+        create_table(create_engine(self.url))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_query(self):
+        async def main():
+            async with AsyncDatabase(self.url, max_workers=2) as db:
+                users = await db.table('users')
+                addresses = await db.table('addresses')
+                total = await users.bulk_insert(
+                    [{'id': i, 'name': 'n{}'.format(i)} for i in range(10)])
+                self.assertEqual(total, 10)
+                await addresses.insert(
+                    {'id': 1, 'user_id': 3, 'email_address': 'a@b.c'})
+
+                answers = await asyncio.gather(
+                    users.query.filter(id__gte=5).all(),
+                    users.query.filter(id=3).one(),
+                    users.join(addresses).values_list('name', flat=True))
+                self.assertEqual(len(answers[0]), 5)
+                self.assertEqual(answers[1].name, 'n3')
+                self.assertEqual(answers[2], ['n3'])
+
+                rows = []
+                async for row in users.query.order_by('id').stream(3):
+                    rows.append(row.id)
+                self.assertEqual(rows, list(range(10)))
+
+                async for row in users.query.order_by('id').stream(2):
+                    break
+                self.assertEqual(await users.query.filter(id__lt=5).delete(),
+                                 5)
+
+        self.run_async(main())
@@ -1,8 +1,26 @@
+import gzip
+import io
 import os
+import tempfile
+import threading
+import time
+from array import array
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
 from dateutil.parser import parse
-from sqlalchemy import create_engine
+from unittest import mock
+import sqlalchemy as sal
+from sqlalchemy import MetaData, create_engine
+from sqlalchemy.dialects import postgresql
 from unittest import TestCase as TestCaseBase
-from dblink import Database, Table
+from dblink import Database, Table, parallel_bulk
+from dblink import Avg, Count, Max, Min, Sum
+from dblink import coercion, columnar
+from dblink.cache import MISSING, DiskStore, MemoryStore
+from benchmarks import bench
+from dblink.exceptions import UnexpectedParam
+from dblink.instrument import MemorySink, normalize_statement
+from dblink.loader import SQLiteLoader, _copy_text
 from sqlalchemy.engine.url import make_url
 from tests import create_table, drop_table
 
@@ -71,6 +89,15 @@ class CoreTest(TestCase):
             answer = {c: getattr(result, c) for c in right.keys()}
             self.assertEqual(answer, right)
 
+            for native in [True, False]:  # ON CONFLICT / per-row fallback
+                with mock.patch('dblink.base.supports_upsert',
+                                return_value=native), \
+                        self.assertRaises(KeyError):
+                    user_table.insert_or_update({'id': 1, 'name': 'b'},
+                                                ['id'], ['name', 'password'])
+                self.assertEqual(list(user_table.query.values_list(
+                    'id', 'name', 'password')), [(1, 'n', 'p')])
+
     def test_C_bulk_insert(self):
         with Database(DB_URL) as db:
             create_table(db.engine)  # For memory sqlite test
@@ -88,6 +115,80 @@ class CoreTest(TestCase):
             right = sorted(data, key=lambda x: x['id'])
             self.assertEqual(answer, right)
 
+    def test_C_bulk_insert_chunked(self):
+        with Database(DB_URL) as db:
+            create_table(db.engine)  # For memory sqlite test
+            user_table = Table('users', db)
+
+            progress = []
+            data = ({'id': i, 'name': 'n{}'.format(i)} for i in range(1, 8))
+            total = user_table.bulk_insert(
+                data, batch_size=3,
+                progress=lambda *args: progress.append(args))
+            self.assertEqual(total, 7)
+            self.assertEqual(progress, [(1, 3, 3), (2, 3, 6), (3, 1, 7)])
+
+            data = ({'id': i, 'name': 'm'} for i in range(5, 10))
+            total = user_table.bulk_insert_or_update(data, ['id'], ['name'],
+                                                     batch_size=2)
+            self.assertEqual(total, 5)
+            total = user_table.bulk_delete(
+                ({'id': i} for i in range(1, 4)), ['id'], batch_size=2)
+            self.assertEqual(total, 3)
+            self.assertEqual(
+                sorted(user_table.query.values_list('id', flat=True)),
+                [4, 5, 6, 7, 8, 9])
+
+    def test_C_bulk_insert_failing_input(self):
+        with Database(DB_URL) as db:
+            create_table(db.engine)  # For memory sqlite test
+            user_table = Table('users', db)
+
+            def data():
+                for i in range(1, 8):
+                    yield {'id': i, 'name': 'n{}'.format(i)}
+                raise RuntimeError('broken input')
+
+            with self.assertRaises(RuntimeError):
+                user_table.bulk_insert(data(), batch_size=3)
+            with self.assertRaises(ValueError):
+                user_table.bulk_insert([{'id': 1}, {'id': 'x'}],
+                                       batch_size=1)
+            # the next write must not commit the batches written before
+            user_table.insert({'id': 100})
+            db.remove_session()
+            self.assertEqual(list(user_table.query.values_list(
+                'id', flat=True)), [100])
+
+    def test_C_bulk_insert_strategies(self):
+        with Database(DB_URL) as db:
+            create_table(db.engine)  # For memory sqlite test
+            birth_info_table = Table('birth_info', db)
+
+            strategies = ['executemany', 'values', 'sqlite',
+                          SQLiteLoader(bulk_pragmas=True)]
+            for i, strategy in enumerate(strategies):
+                data = [{'user_id': i, 'birthday': date(2010, 1, j)}
+                        for j in range(1, 11)]
+                total = birth_info_table.bulk_insert(
+                    data, batch_size=4, strategy=strategy)
+                self.assertEqual(total, 10)
+                answer = birth_info_table.query.filter(user_id=i) \
+                    .order_by('birthday').values_list('birthday', flat=True)
+                self.assertEqual(list(answer), [d['birthday'] for d in data])
+            self.assertRaises(UnexpectedParam, birth_info_table.bulk_insert,
+                              data, strategy='unknown')
+            # driver errors come out as SQLAlchemy exceptions
+            self.assertRaises(sal.exc.IntegrityError,
+                              birth_info_table.bulk_insert, data,
+                              strategy='sqlite')
+            self.assertEqual(_copy_text('a\tb\\'), 'a\\tb\\\\')
+            self.assertEqual(_copy_text(None), '\\N')
+            self.assertEqual(_copy_text([1, 2]), '{"1","2"}')
+            self.assertEqual(_copy_text([['a"', None], ['b\\']]),
+                             '{{"a\\\\"",NULL},{"b\\\\\\\\"}}')
+            self.assertRaises(TypeError, _copy_text, {'a': '1'})
+
     def test_D_bulk_update(self):
         with Database(DB_URL) as db:
             create_table(db.engine)  # For memory sqlite test
@@ -111,6 +212,67 @@ class CoreTest(TestCase):
             right = sorted(data2, key=lambda x: x['id'])
             self.assertEqual(answer, right)
 
+    def test_D_bulk_update_staged(self):
+        with Database(DB_URL) as db:
+            create_table(db.engine)  # For memory sqlite test
+            user_table = Table('users', db)
+            user_table.bulk_insert(
+                {'id': i, 'name': 'n{}'.format(i), 'fullname': 'f'}
+                for i in range(10))
+            data = [{'id': i, 'name': 'u{}'.format(i), 'fullname': 'x'}
+                    for i in range(1, 9)]
+            data += [{'id': 1, 'name': 'last', 'fullname': 'x'},
+                     {'id': None, 'name': 'null', 'fullname': 'x'},
+                     {'id': 99, 'name': 'missing', 'fullname': 'x'}]
+            right = [(0, 'n0')] + [(i, 'u{}'.format(i)) for i in range(2, 9)]
+            right = sorted(right + [(1, 'last'), (9, 'n9')])
+
+            for version in [(3, 40, 0), (3, 30, 0)]:  # UPDATE FROM / subquery
+                with mock.patch('dblink.staging.sqlite_version',
+                                return_value=version):
+                    user_table.bulk_update(
+                        [dict(d, name='?') for d in data], ['id'], ['name'],
+                        strategy='staged')
+                    self.assertEqual(
+                        len(user_table.query.filter(name='?').all()), 8)
+                    rows = user_table.bulk_update(data, ['id'], ['name'],
+                                                  strategy='staged',
+                                                  batch_size=4)
+                self.assertEqual(rows, len(data))
+                self.assertEqual(sorted(user_table.query.values_list(
+                    'id', 'name')), right)
+            self.assertEqual(user_table.query.filter(fullname='x').all(), [])
+
+            with mock.patch.object(Table, 'STAGED_UPDATE_THRESHOLD', 3), \
+                    mock.patch.object(Table, '_update_chunk') as per_row:
+                user_table.bulk_update(data, ['id'], ['name'], batch_size=4)
+            self.assertEqual(per_row.call_count, 0)
+            with self.assertRaises(UnexpectedParam):
+                user_table.bulk_update(data, ['id'], ['name'],
+                                       strategy='merge')
+            self.assertEqual(
+                db.engine.table_names(connection=db.session.connection()),
+                ['addresses', 'birth_info', 'messages', 'users'])
+
+            def failing():
+                yield from data[:4]
+                raise RuntimeError('source failed')
+
+            temp_tables = "SELECT name FROM sqlite_temp_master " \
+                "WHERE type = 'table'"
+            with db.transaction():
+                with self.assertRaises(RuntimeError):
+                    user_table.bulk_update(failing(), ['id'], ['name'],
+                                           strategy='staged', batch_size=2)
+                self.assertEqual(
+                    db.session.execute(temp_tables).fetchall(), [])
+            # like PostgreSQL in an aborted transaction
+            aborted = sal.exc.InternalError('DROP', {}, Exception('aborted'))
+            with mock.patch.object(sal.Table, 'drop', side_effect=aborted), \
+                    self.assertRaises(RuntimeError):
+                user_table.bulk_update(failing(), ['id'], ['name'],
+                                       strategy='staged', batch_size=2)
+
     def test_E_bulk_update_or_insert(self):
         with Database(DB_URL) as db:
             create_table(db.engine)  # For memory sqlite test
@@ -131,6 +293,26 @@ class CoreTest(TestCase):
             right = sorted(data2, key=lambda x: x['id'])
             self.assertEqual(answer, right)
 
+    def test_E_bulk_update_or_insert_fallback(self):
+        with Database(DB_URL) as db:
+            create_table(db.engine)  # For memory sqlite test
+            user_table = Table('users', db)
+            self.assertIn({'id'}, user_table.unique_keys)
+            self.assertNotIn({'name'}, user_table.unique_keys)
+
+            data = {'id': 1, 'name': 'n1', 'fullname': 'f1', 'password': 'p1'}
+            user_table.insert(data)
+            data2 = [
+                {'id': 1, 'name': 'n1', 'fullname': 'f', 'password': 'p'},
+                {'id': 2, 'name': 'n2', 'fullname': 'f2', 'password': 'p2'},
+            ]
+            user_table.bulk_insert_or_update(data2, ['name'],
+                                             ['fullname', 'password'])
+            answer = sorted(user_table.query.values_list(
+                'id', 'name', 'fullname', 'password'))
+            right = [(1, 'n1', 'f', 'p'), (2, 'n2', 'f2', 'p2')]
+            self.assertEqual(answer, right)
+
     def test_F_delete(self):
         with Database(DB_URL) as db:
             create_table(db.engine)  # For memory sqlite test
@@ -160,6 +342,60 @@ class CoreTest(TestCase):
             answer = user_table.query.one_or_none()
             self.assertEqual(answer, None)
 
+    def test_G_bulk_delete_batched(self):
+        with Database(DB_URL) as db:
+            create_table(db.engine)  # For memory sqlite test
+            user_table = Table('users', db)
+            user_table.bulk_insert({'id': i, 'name': 'n'} for i in range(50))
+            with mock.patch('dblink.base.max_bind_params', return_value=7):
+                rows = user_table.bulk_delete(
+                    [{'id': i} for i in range(0, 50, 2)] + [{'id': None}],
+                    unique_fields=['id'], batch_size=20)
+            self.assertEqual(rows, 26)
+            self.assertEqual(sorted(user_table.query.values_list(
+                'id', flat=True)), list(range(1, 50, 2)))
+            with self.assertRaises(ValueError):
+                user_table.bulk_delete([{'id': 1}], unique_fields=[])
+
+            birth_info_table = Table('birth_info', db)
+            days = [date(2010, 1, 1) + timedelta(days=i) for i in range(6)]
+            data = [{'user_id': i % 2, 'birthday': d}
+                    for i, d in enumerate(days)]
+            for row_values in [True, False]:  # tuple IN / staging table
+                birth_info_table.bulk_insert(data)
+                with mock.patch('dblink.base.supports_row_values',
+                                return_value=row_values):
+                    birth_info_table.bulk_delete(
+                        data[:4], ['user_id', 'birthday'], batch_size=3)
+                self.assertEqual(sorted(birth_info_table.query.values_list(
+                    'user_id', 'birthday')), [(0, days[4]), (1, days[5])])
+                birth_info_table.bulk_delete(data, ['birthday', 'user_id'])
+                self.assertEqual(birth_info_table.query.all(), [])
+
+            def failing():
+                yield from data[:4]
+                raise RuntimeError('source failed')
+
+            temp_tables = "SELECT name FROM sqlite_temp_master " \
+                "WHERE type = 'table'"
+            with db.transaction(), \
+                    mock.patch('dblink.base.supports_row_values',
+                               return_value=False):
+                with self.assertRaises(RuntimeError):
+                    birth_info_table.bulk_delete(
+                        failing(), ['user_id', 'birthday'], batch_size=2)
+                self.assertEqual(
+                    db.session.execute(temp_tables).fetchall(), [])
+            # like PostgreSQL in an aborted transaction
+            aborted = sal.exc.InternalError('DROP', {}, Exception('aborted'))
+            with mock.patch('dblink.base.supports_row_values',
+                            return_value=False), \
+                    mock.patch.object(sal.Table, 'drop',
+                                      side_effect=aborted), \
+                    self.assertRaises(RuntimeError):
+                birth_info_table.bulk_delete(
+                    failing(), ['user_id', 'birthday'], batch_size=2)
+
     def test_H_get_or_insert(self):
         with Database(DB_URL) as db:
             create_table(db.engine)  # For memory sqlite test
@@ -177,6 +413,63 @@ class CoreTest(TestCase):
             self.assertEqual(flag, False)
             self.assertEqual(answer, data)
 
+    def test_H_get_or_insert_many(self):
+        sink = MemorySink()
+        with Database(DB_URL, metrics_sink=sink) as db:
+            create_table(db.engine)  # For memory sqlite test
+            user_table = Table('users', db)
+            user_table.bulk_insert([{'id': 1, 'name': 'n1'},
+                                    {'id': 2, 'name': 'n2'}])
+            items = [{'id': 2, 'name': 'x'}, {'id': '3', 'name': 'n3'},
+                     {'id': 4}, {'id': 3, 'name': 'x'}, {'id': 1},
+                     {'id': 5, 'name': 'n5'}]
+            # loaded through the session, so every statement is counted
+            with mock.patch.dict('dblink.loader.DEFAULT_LOADERS',
+                                 {'sqlite': 'executemany'}):
+                answer = user_table.get_or_insert_many(items, ['id'])
+            self.assertEqual([(row.id, row.name, created)
+                              for row, created in answer],
+                             [(2, 'n2', False), (3, 'n3', True),
+                              (4, None, True), (3, 'n3', False),
+                              (1, 'n1', False), (5, 'n5', True)])
+            # keyed select, an insert per column set, select of new rows
+            self.assertEqual(sink.events[-1].statements, 4)
+            user_table.get_or_insert_many(items, ['id'])
+            self.assertEqual(sink.events[-1].statements, 1)
+            self.assertEqual(len(user_table.query.all()), 5)
+
+            birth_info_table = Table('birth_info', db)
+            answer = birth_info_table.get_or_insert_many(
+                [{'user_id': 1, 'birthday': '2010-01-01'}] * 2,
+                ['user_id', 'birthday'])
+            self.assertEqual([tuple(row) + (created,)
+                              for row, created in answer],
+                             [(1, date(2010, 1, 1), True),
+                              (1, date(2010, 1, 1), False)])
+            with self.assertRaises(ValueError):
+                user_table.get_or_insert_many([{'id': None}], ['id'])
+
+            # PostgreSQL inserts the missing rows with RETURNING instead
+            rows = [{'id': 6, 'name': 'n6'}, {'id': 7, 'name': 'n7'},
+                    {'id': 8, 'name': 'n8'}]
+            with mock.patch.object(Table, 'session') as session, \
+                    mock.patch('dblink.base.max_bind_params',
+                               return_value=4):
+                session.execute.side_effect = \
+                    lambda stmt: stmt.parameters
+                answer = user_table._insert_returning(rows, ['id'])
+            self.assertEqual(answer, {(r['id'],): r for r in rows})
+            statements = [str(call[0][0].compile(
+                dialect=postgresql.dialect()))
+                for call in session.execute.call_args_list]
+            returning = ' RETURNING users.id, users.name, ' \
+                'users.fullname, users.password'
+            self.assertEqual(statements, [
+                'INSERT INTO users (id, name) VALUES (%(id_m0)s, '
+                '%(name_m0)s), (%(id_m1)s, %(name_m1)s)' + returning,
+                'INSERT INTO users (id, name) VALUES (%(id_m0)s, '
+                '%(name_m0)s)' + returning])
+
     def test_I_bulk_update_or_insert_with_datetime(self):
 
         with Database(DB_URL) as db:
@@ -202,6 +495,105 @@ class CoreTest(TestCase):
                           .values_list('user_id', flat=True))
             self.assertEqual(results, {1, 2})
 
+    def test_I_bulk_update_or_insert_composite_keys(self):
+        with Database(DB_URL) as db:
+            create_table(db.engine)  # For memory sqlite test
+            birth_info_table = Table('birth_info', db)
+            days = [date(2010, 1, 1), date(2010, 1, 2)]
+            existing = [{'user_id': 1, 'birthday': days[0]},
+                        {'user_id': 1, 'birthday': days[1]},
+                        {'user_id': 2, 'birthday': days[0]}]
+            data = [{'user_id': 1, 'birthday': days[0]},
+                    {'user_id': 2, 'birthday': days[1]}]
+            matched, original = [], Table._existing_keys
+
+            def existing_keys(table, keys, unique_fields):
+                matched.append(original(table, keys, unique_fields))
+                return matched[-1]
+
+            for row_values in [True, False]:  # (a, b) IN / OR of ANDs
+                birth_info_table.query.delete()
+                birth_info_table.bulk_insert(existing)
+                with mock.patch('dblink.base.supports_upsert',
+                                return_value=False), \
+                        mock.patch('dblink.base.supports_row_values',
+                                   return_value=row_values), \
+                        mock.patch.object(Table, '_existing_keys',
+                                          autospec=True,
+                                          side_effect=existing_keys):
+                    birth_info_table.bulk_insert_or_update(
+                        data, ['user_id', 'birthday'], ['user_id'])
+                # only the exact key, not the (1, 2) x (day 1, day 2) product
+                self.assertEqual([set(k) for k in matched.pop()],
+                                 [{1, days[0]}])
+                self.assertEqual(len(birth_info_table.query.all()), 4)
+
+    def test_J_coercion(self):
+        with Database(DB_URL) as db:
+            create_table(db.engine)  # For memory sqlite test
+            birth_info_table = Table('birth_info', db)
+            birth_info_table.bulk_insert([
+                {'user_id': '1', 'birthday': '2010-01-01'},
+                {'user_id': '2', 'birthday': 'Jan 2 2010'},
+            ])
+            data = [{'user_id': 2, 'birthday': '2010-01-02'},
+                    {'user_id': '3', 'birthday': date(2010, 1, 3)}]
+            with mock.patch('dblink.base.supports_upsert',
+                            return_value=False):
+                birth_info_table.bulk_insert_or_update(
+                    data, ['user_id', 'birthday'], ['user_id'])
+            self.assertEqual(sorted(birth_info_table.query.values_list(
+                'user_id', 'birthday')), [(1, date(2010, 1, 1)),
+                                          (2, date(2010, 1, 2)),
+                                          (3, date(2010, 1, 3))])
+            query = birth_info_table.query
+            self.assertEqual(len(query.filter(
+                birthday__range=('2010-01-02', '2010-01-03')).all()), 2)
+            self.assertEqual(query.filter(user_id='3').one().user_id, 3)
+            self.assertEqual(sorted(query.filter(
+                user_id__in=['1', 2]).values_list('user_id', flat=True)),
+                [1, 2])
+            with self.assertRaises(ValueError):
+                query.filter(user_id='x')
+
+            user_table = Table('users', db)
+            user_table.bulk_insert([{'id': '1', 'name': ''}])
+            self.assertEqual(user_table.query.filter(id='').all(), [])
+            self.assertEqual(user_table.query.one().name, '')
+
+        table = sal.Table(
+            't', MetaData(), sal.Column('at', sal.DateTime),
+            sal.Column('flag', sal.Boolean), sal.Column('price', sal.Numeric),
+            sal.Column('ratio', sal.Float), sal.Column('note', sal.String))
+        coercer = coercion.coercer_for(table)
+        self.assertIs(coercion.coercer_for(table), coercer)
+        self.assertEqual(coercer.row({
+            'at': '2010-01-02T03:04:05+00:00', 'flag': 'Yes',
+            'price': '1.10', 'ratio': '', 'note': ''}), {
+            'at': datetime(2010, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+            'flag': True, 'price': Decimal('1.10'), 'ratio': None,
+            'note': ''})
+        self.assertEqual(coercer.value('at', '2 Jan 2010 3:04'),
+                         datetime(2010, 1, 2, 3, 4))
+        self.assertEqual(coercer.value('at', date(2010, 1, 2)),
+                         datetime(2010, 1, 2))
+        with self.assertRaises(ValueError):
+            coercer.value('flag', 'maybe')
+
+        # the parsers of Pythons without fromisoformat
+        self.assertEqual(coercion.parse_iso_datetime('2010-01-02'),
+                         datetime(2010, 1, 2))
+        self.assertEqual(coercion.parse_iso_datetime('2010-01-02 03:04:05.5'),
+                         datetime(2010, 1, 2, 3, 4, 5, 500000))
+        self.assertEqual(coercion.parse_iso_time('03:04'),
+                         datetime(2010, 1, 1, 3, 4).time())
+        with self.assertRaises(ValueError):
+            coercion.parse_iso_datetime('2010-01-02T03:04+01:00')
+        with mock.patch.object(coercion, '_iso_datetime',
+                               coercion.parse_iso_datetime):
+            self.assertEqual(coercion.to_datetime('2 Jan 2010 3:04'),
+                             datetime(2010, 1, 2, 3, 4))
+
 
 class QueryTest(TestCase):
     @staticmethod
@@ -270,6 +662,25 @@ class QueryTest(TestCase):
                         (1, 'n1', 'jack@msn.com', 'f1')])
         self.assertEqual(sorted(answer), right)
 
+    def test_E_join_path(self):
+        message_table = Table('messages', self.db)
+        message_table.bulk_insert([
+            {'id': 1, 'address_id': 1, 'subject': 's1'},
+            {'id': 2, 'address_id': 3, 'subject': 's2'},
+        ])
+        answer = self.user_table.join(message_table) \
+            .order_by('messages.id') \
+            .values_list('users.name', 'email_address', 'subject')
+        right = [('n1', 'jack@yahoo.com', 's1'), ('n2', 'www@www.org', 's2')]
+        self.assertEqual(list(answer), right)
+
+        answer = self.user_table.join(self.address_table, message_table) \
+            .filter(subject='s2').values_list('users.id', flat=True)
+        self.assertEqual(list(answer), [2])
+        graph = self.db.join_graph
+        self.user_table.join(message_table)
+        self.assertIs(self.db.join_graph, graph)
+
     def test_F_delete(self):
         items = self.address_table.query.filter(id=1)
         delete_count = items.delete()
@@ -296,7 +707,702 @@ class QueryTest(TestCase):
         result = self.user_table.query.filter('users.id > 1').all()
         self.assertEqual(result, [(2, 'n2', 'f2', 'p2')])
 
+    def test_J_huge_in(self):
+        ids = list(range(2, 50000))
+        query = self.user_table.query.filter(id__in=ids)
+        self.assertEqual(list(query.values_list('id', flat=True)), [2])
+        self.assertEqual(
+            list(self.user_table.query.exclude(id__in=ids)
+                 .values_list('id', flat=True)), [1])
+
+        birth_info_table = Table('birth_info', self.db)
+        birth_info_table.bulk_insert([
+            {'user_id': 1, 'birthday': date(2010, 1, 1)},
+            {'user_id': 2, 'birthday': date(2010, 1, 2)},
+        ])
+        days = [date(2010, 1, 2) + timedelta(days=i) for i in range(5000)]
+        query = birth_info_table.query.filter(birthday__in=days)
+        self.assertEqual(len(query.staged), 1)
+        self.assertEqual(list(query.values_list('user_id', flat=True)), [2])
+        self.assertEqual(query.one().user_id, 2)
+        # the staged rows do not outlive their transaction
+        self.db.session.rollback()
+        self.assertEqual(query.one().user_id, 2)
+        self.db.remove_session()
+        self.assertEqual(query.one().user_id, 2)
+
+    def test_K_stream(self):
+        answer = self.address_table.query.filter(user_id=2).order_by('id') \
+            .stream(batch_size=1)
+        self.assertEqual([r.id for r in answer], [3, 4])
+        answer = self.address_table.query.order_by('id') \
+            .values_list('id', flat=True, stream=True, batch_size=3)
+        self.assertEqual(list(answer), [1, 2, 3, 4])
+
+    def test_L_statement_cache(self):
+        cache = self.db.statement_cache
+        cache.clear()
+        for i in (1, 2, 1):
+            answer = self.user_table.query.filter(id=i, name__startswith='n')
+            self.assertEqual(answer.one().id, i)
+        stats = cache.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 4)
+
+        self.user_table.prepare('by_ids', 'id__in', order_by=['-id'],
+                                fields=['id', 'name'])
+        answer = self.user_table.prepared('by_ids', id__in=[1, 2]).all()
+        self.assertEqual(answer, [(2, 'n2'), (1, 'n1')])
+        answer = self.user_table.prepared('by_ids', id__in=[1]).all()
+        self.assertEqual(answer, [(1, 'n1')])
+        self.assertEqual(cache.stats()['size'], 4)
+
+        offset = 1
+
+        def shifted(column):
+            return column + offset
+
+        for offset in (1, 10):
+            answer = self.user_table.query.filter(id=1) \
+                .values_list(id=shifted, flat=True)
+            self.assertEqual(list(answer), [1 + offset])
+        self.assertEqual(cache.stats()['size'], 4)
+
+    def test_M_to_columns(self):
+        answer = self.address_table.query.order_by('id') \
+            .to_columns('id', 'user_id', 'email_address', batch_size=3)
+        self.assertEqual(list(answer), ['id', 'user_id', 'email_address'])
+        self.assertEqual(list(answer['id']), [1, 2, 3, 4])
+        self.assertEqual(list(answer['email_address'])[-1], 'wendy@aol.com')
+
+        with mock.patch.object(columnar, 'numpy', None):
+            answer = self.user_table.query.to_columns()
+            self.assertEqual(answer['id'], array('q', [1, 2]))
+            self.address_table.insert({'id': 5, 'email_address': 'e'})
+            answer = self.address_table.query.order_by('id') \
+                .to_columns('user_id', batch_size=2)
+            self.assertEqual(answer['user_id'].typecode, 'd')
+            self.assertEqual(list(answer['user_id'])[:4], [1, 1, 2, 2])
+
+        answer = self.user_table.join(self.address_table) \
+            .order_by('addresses.id') \
+            .to_columns('users.id', 'addresses.id', 'email_address', 'name')
+        self.assertEqual(list(answer), ['users_id', 'addresses_id',
+                                        'email_address', 'name'])
+        self.assertEqual(list(answer['addresses_id']), [1, 2, 3, 4])
+        self.assertEqual(list(answer['name'])[:2], ['n1', 'n1'])
+
+    def test_N_iter_chunks(self):
+        self.user_table.bulk_insert(
+            [{'id': i, 'name': 'n{}'.format(i)} for i in range(3, 10)])
+        chunks = self.user_table.query.exclude(id=5).iter_chunks(3)
+        answer = [[row.id for row in chunk] for chunk in chunks]
+        self.assertEqual(answer, [[1, 2, 3], [4, 6, 7], [8, 9]])
+        answer = [row.id for row in self.user_table.scan(4, id__gte=6)]
+        self.assertEqual(answer, [6, 7, 8, 9])
+        self.user_table.bulk_update(
+            [{'id': i, 'name': 'same'} for i in range(3, 10)], ['id'],
+            ['name'])
+        answer = [row.id for row in self.user_table.scan(2, key='name')]
+        self.assertEqual(answer, [1, 2, 3, 4, 5, 6, 7, 8, 9])
+
+        birth_info_table = Table('birth_info', self.db)
+        birth_info_table.bulk_insert([
+            {'user_id': i % 3, 'birthday': date(2010, 1, 1 + i)}
+            for i in range(10)])
+        right = sorted((r.user_id, r.birthday)
+                       for r in birth_info_table.query.all())
+        for row_values in (True, False):
+            with mock.patch('dblink.base.supports_row_values',
+                            return_value=row_values):
+                answer = [(r.user_id, r.birthday) for r in
+                          birth_info_table.scan(4, ['user_id', 'birthday'])]
+            self.assertEqual(answer, right)
+
+    def test_O_aggregates(self):
+        user, address = self.user_table, self.address_table
+        self.assertEqual(user.query.count(), 2)
+        self.assertEqual(address.query.filter(user_id=2).count(), 2)
+        self.assertTrue(address.query.filter(email_address='www@www.org')
+                        .exists())
+        self.assertFalse(address.query.filter(id__gt=4).exists())
+
+        self.assertEqual(
+            address.query.order_by('-id').aggregate(
+                Count(), Max('id'), first=Min('email_address')),
+            {'count': 4, 'id__max': 4, 'first': 'jack@msn.com'})
+        self.assertEqual(address.query.filter(id__gt=9).aggregate(
+            total=Sum('id'), mean=Avg('id')), {'total': None, 'mean': None})
+
+        joined = user.join(address)
+        self.assertEqual(joined.filter(name='n1').count(), 2)
+        self.assertEqual(joined.aggregate(
+            users=Count('users.id', distinct=True),
+            total=Sum('addresses.id')), {'users': 2, 'total': 10})
+
+        per_user = joined.group_by('name').annotate(
+            emails=Count('email_address'), last=Max('addresses.id'))
+        self.assertEqual(sorted(per_user.values_list('name', 'emails')),
+                         [('n1', 2), ('n2', 2)])
+        self.assertEqual(
+            [tuple(r) for r in per_user.having(last__gte=3)
+             .order_by('-last').all()], [('n2', 2, 4)])
+        self.assertEqual(per_user.having(last__gte=3).count(), 1)
+        self.assertEqual(sorted(
+            address.query.annotate(Count('id')).group_by('user_id')
+            .filter(id__gt=1).values_list('user_id', 'id__count')),
+            [(1, 1), (2, 2)])
+        with self.assertRaises(UnexpectedParam):
+            per_user.aggregate(Count())
+
     def test_others(self):
         dialect = make_url(DB_URL).get_dialect().name
         self.assertEqual(self.db.dialect, dialect)
         self.assertIn("Table('users',", self.user_table.description)
+
+
+class SchemaCacheTest(TestCaseBase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.url = 'sqlite:///' + os.path.join(self.tmp.name, 'db.sqlite')
+        self.cache = os.path.join(self.tmp.name, 'schema.cache')
+        create_table(create_engine(self.url))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_reflect_and_cache(self):
+        with Database(self.url, reflect=['users', 'addresses'],
+                      schema_cache=self.cache) as db:
+            self.assertEqual(sorted(db.metadata.tables),
+                             ['addresses', 'users'])
+            db.tables.users.insert({'id': 1, 'name': 'n1'})
+            self.assertIs(db.tables['users'], db.tables.users)
+            self.assertIn('birth_info', db.tables)
+        self.assertTrue(os.path.exists(self.cache))
+
+        with mock.patch.object(MetaData, 'reflect',
+                               side_effect=AssertionError):
+            with Database(self.url, reflect=['users'],
+                          schema_cache=self.cache) as db:
+                self.assertEqual(db.tables.users.query.one().name, 'n1')
+
+        with create_engine(self.url).connect() as connection:
+            connection.execute('CREATE TABLE other (id INTEGER)')
+        with Database(self.url, schema_cache=self.cache) as db:
+            self.assertIn('other', db.metadata.tables)
+
+
+class ConcurrentTest(TestCaseBase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.url = 'sqlite:///' + os.path.join(self.tmp.name, 'db.sqlite')
+        create_table(create_engine(self.url))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_thread_sessions(self):
+        with Database(self.url) as db:
+            sessions = [db.session]
+            thread = threading.Thread(
+                target=lambda: sessions.append(db.session))
+            thread.start()
+            thread.join()
+            self.assertIsNot(sessions[0], sessions[1])
+            self.assertIs(sessions[0], db.session)
+            self.assertIn('pool', db.pool_status())
+
+    def test_parallel_bulk(self):
+        with Database(self.url) as db:
+            user_table = Table('users', db)
+            data = ({'id': i, 'name': 'n{}'.format(i)} for i in range(500))
+            total = parallel_bulk(user_table, 'bulk_insert', data,
+                                  workers=4, batch_size=50)
+            self.assertEqual(total, 500)
+            self.assertEqual(len(user_table.query.all()), 500)
+
+    def test_parallel_iter(self):
+        with Database(self.url) as db:
+            user_table = Table('users', db)
+            user_table.bulk_insert({'id': i, 'name': 'n{}'.format(i % 7)}
+                                   for i in range(1, 2001))
+            query = user_table.query.filter(name__in=['n1', 'n2'])
+            expected = sorted(query.values_list('id', flat=True))
+
+            parts = query.partitions(4)
+            self.assertEqual([p.count() for p in parts], [144, 142, 142, 144])
+            parts = query.partitions(4, method='quantiles')
+            self.assertEqual(sum(p.count() for p in parts), len(expected))
+            self.assertLessEqual(max(p.count() for p in parts), 143)
+
+            rows = list(query.parallel_iter(workers=3, batch_size=20))
+            self.assertEqual(sorted(r.id for r in rows), expected)
+            rows = query.parallel_iter(workers=3, batch_size=20, ordered=True,
+                                       method='quantiles')
+            self.assertEqual([r.id for r in rows], expected)
+            self.assertEqual(sorted(query.parallel_map(
+                lambda row: row.id * 2, workers=2)),
+                [i * 2 for i in expected])
+
+    def test_parallel_map_processes(self):
+        with Database(self.url) as db:
+            user_table = Table('users', db)
+            user_table.bulk_insert({'id': i} for i in range(100))
+            result = user_table.query.values('id').parallel_map(
+                sum, workers=2, processes=2, ordered=True, batch_size=10)
+            self.assertEqual(list(result), list(range(100)))
+
+    def test_parallel_partitions(self):
+        with Database(self.url) as db:
+            birth_table = Table('birth_info', db)
+            birth_table.bulk_insert(
+                {'user_id': i, 'birthday': date(2000, 1, 1) +
+                 timedelta(days=i)} for i in range(30))
+            parts = birth_table.query.partitions(3, partition_by='birthday')
+            self.assertEqual([p.count() for p in parts], [9, 10, 11])
+            with self.assertRaises(UnexpectedParam):
+                birth_table.query.partitions(3)
+            user_table = Table('users', db)
+            user_table.bulk_insert([{'id': 1, 'name': 'a'}])
+            with self.assertRaises(UnexpectedParam):
+                user_table.query.partitions(3, partition_by='name')
+            self.assertEqual(len(user_table.query.partitions(
+                3, partition_by='name', method='quantiles')), 1)
+            self.assertEqual(len(user_table.query.filter(id=2).partitions(3)),
+                             1)
+
+            # worker errors reach the consumer
+            with mock.patch('dblink.base.Query.stream',
+                            side_effect=ValueError('broken')):
+                with self.assertRaises(ValueError):
+                    list(user_table.query.parallel_iter(workers=2))
+
+    def test_transaction(self):
+        with Database(self.url) as db:
+            user_table = Table('users', db)
+            with mock.patch.object(db.session, 'commit',
+                                   wraps=db.session.commit) as commit:
+                with db.transaction():
+                    for i in range(10):
+                        user_table.insert({'id': i, 'name': 'n'})
+                    user_table.update({'id': 1, 'name': 'u'}, ['id'],
+                                      ['name'])
+                    user_table.get_or_insert(id=10)
+                self.assertEqual(commit.call_count, 1)
+
+            with self.assertRaises(ValueError):
+                with db.batch():
+                    user_table.query.filter(id__gte=5).delete()
+                    raise ValueError('rolled back')
+            self.assertEqual(user_table.query.count(), 11)
+
+            with db.transaction():
+                user_table.insert({'id': 20})
+                with self.assertRaises(sal.exc.IntegrityError):
+                    with db.transaction():
+                        user_table.insert({'id': 21})
+                        user_table.insert({'id': 1})
+                with db.transaction():
+                    user_table.insert({'id': 22})
+            self.assertEqual(sorted(user_table.query.filter(
+                id__gte=20).values_list('id', flat=True)), [20, 22])
+
+            with self.assertRaises(RuntimeError):
+                with db.transaction():
+                    with db.transaction():
+                        user_table.insert({'id': 30})
+                    raise RuntimeError('outer')
+            self.assertFalse(user_table.query.filter(id=30).exists())
+
+    def test_transaction_cache(self):
+        with Database(self.url) as db:
+            user_table = Table('users', db)
+            user_table.enable_cache()
+            self.assertEqual(user_table.query.count(), 0)
+            with db.transaction():
+                user_table.insert({'id': 1})
+                self.assertEqual(user_table.query.count(), 1)
+                with mock.patch.object(db, 'invalidate_results') as inval:
+                    user_table.insert({'id': 2})
+                    self.assertFalse(inval.called)
+            self.assertEqual(user_table.query.count(), 2)
+
+
+class InstrumentationTest(TestCaseBase):
+    def test_events(self):
+        sink = MemorySink()
+        with Database(DB_URL, metrics_sink=sink,
+                      slow_query_threshold=0) as db:
+            create_table(db.engine)  # For memory sqlite test
+            user_table = Table('users', db)
+            with self.assertLogs('DBLink.slow', level='WARNING'):
+                user_table.bulk_insert(
+                    [{'id': i, 'name': 'n'} for i in range(5)],
+                    batch_size=2, strategy='executemany')
+            user_table.query.filter(id__gte=3).all()
+            user_table.query.filter(id__gte=1).all()
+            user_table.query.filter(id=1).delete()
+
+        insert, select, _, delete = list(sink.events)
+        self.assertEqual(insert.operation, 'Table.bulk_insert')
+        self.assertEqual((insert.rows, insert.batches), (5, 3))
+        self.assertIsNotNone(insert.commit_time)
+        self.assertTrue(insert.statement.startswith('INSERT INTO users'))
+        self.assertEqual((select.operation, select.rows), ('Query.all', 2))
+        self.assertEqual((delete.operation, delete.rows), ('Query.delete', 1))
+        top = sink.top()
+        self.assertEqual(top[0]['count'] + top[1]['count'] + top[2]['count'],
+                         4)
+        self.assertEqual(
+            normalize_statement("SELECT a FROM t WHERE b IN (?, ?, ?) "
+                                "AND c = 'x'  AND d = 3"),
+            "SELECT a FROM t WHERE b IN (...) AND c = ? AND d = ?")
+
+
+class BenchmarkTest(TestCaseBase):
+    def test_smoke(self):
+        report = bench.run_suite(backends=['memory'], sizes=[50], repeat=1,
+                                 batch_size=20)
+        operations = [r['operation'] for r in report['results']]
+        self.assertEqual(len(operations), 14)
+        self.assertIn('join', operations)
+        for result in report['results']:
+            self.assertGreater(result['rows'], 0)
+            self.assertLessEqual(result['p50'], result['p99'])
+
+        rows, regressed = bench.compare(report, report)
+        self.assertEqual(len(rows), 14)
+        self.assertFalse(regressed)
+        slower = {'results': [dict(r, rows_per_sec=r['rows_per_sec'] * 2)
+                              for r in report['results']]}
+        self.assertTrue(bench.compare(report, slower)[1])
+
+
+class ResultCacheTest(TestCaseBase):
+    def test_table_cache(self):
+        with Database(DB_URL) as db:
+            create_table(db.engine)  # For memory sqlite test
+            user_table = Table('users', db)
+            user_table.bulk_insert([{'id': 1, 'name': 'n1'},
+                                    {'id': 2, 'name': 'n2'}])
+            user_table.enable_cache()
+            store = db.result_cache
+
+            first = user_table.query.filter(id__gte=1).all()
+            first.append('junk')
+            self.assertEqual(len(user_table.query.filter(id__gte=1).all()),
+                             2)
+            self.assertEqual(sorted(user_table.query.values_list(
+                'name', flat=True)), ['n1', 'n2'])
+            self.assertEqual(sorted(user_table.query.values_list(
+                'name', flat=True)), ['n1', 'n2'])
+            self.assertEqual(user_table.query.filter(id=9).one_or_none(),
+                             None)
+            self.assertEqual(user_table.query.filter(id=9).one_or_none(),
+                             None)
+            self.assertEqual((store.hits, store.misses), (3, 3))
+
+            user_table.insert({'id': 3, 'name': 'n3'})
+            self.assertEqual(store.invalidations, 3)
+            self.assertEqual(len(user_table.query.filter(id__gte=1).all()),
+                             3)
+            user_table.query.filter(id=3).delete()
+            self.assertEqual(len(user_table.query.filter(id__gte=1).all()),
+                             2)
+            self.assertEqual(store.stats()['size'], 1)
+
+            address_table = Table('addresses', db)
+            query = address_table.query.cache()
+            query.all()
+            query.all()
+            address_table.bulk_insert([{'id': 1, 'email_address': 'a',
+                                        'user_id': 1}])
+            self.assertEqual(len(query.all()), 1)
+            self.assertEqual(store.hits, 4)
+            query.cache(False).all()
+            self.assertEqual(store.misses, 7)
+
+            user_table.disable_cache()
+            user_table.query.all()
+            self.assertEqual(store.misses, 7)
+
+    def test_cache_key_of_functions(self):
+        with Database(DB_URL) as db:
+            create_table(db.engine)  # For memory sqlite test
+            user_table = Table('users', db)
+            user_table.bulk_insert([{'id': 1, 'name': 'n1'}])
+            user_table.enable_cache()
+            store = db.result_cache
+
+            def shifted(offset):
+                return list(user_table.query.values_list(
+                    id=lambda c: c + offset, flat=True))
+
+            self.assertEqual(shifted(1), [2])
+            self.assertEqual(shifted(1), [2])
+            self.assertEqual(shifted(10), [11])
+            self.assertEqual((store.hits, store.misses), (1, 2))
+
+    def test_memory_store(self):
+        store = MemoryStore(maxsize=2, ttl=10)
+        store.set('a', 1, ['t1'])
+        store.set('b', 2, ['t2'])
+        store.set('c', 3, ['t1', 't2'])
+        self.assertIs(store.get('a'), MISSING)
+        self.assertEqual(store.evictions, 1)
+        generation = store.generation(['t1'])
+        store.invalidate('t1')
+        self.assertEqual(store.get('b'), 2)
+        self.assertIs(store.get('c'), MISSING)
+        store.set('d', 4, ['t1'], generation)  # read before the write
+        self.assertIs(store.get('d'), MISSING)
+        with mock.patch('dblink.cache.time.time',
+                        return_value=time.time() + 11):
+            self.assertIs(store.get('b'), MISSING)
+        self.assertEqual(store.stats(), {
+            'hits': 1, 'misses': 4, 'evictions': 2, 'invalidations': 1,
+            'size': 0, 'maxsize': 2})
+
+    def test_disk_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'results.sqlite')
+            store = DiskStore(path, maxsize=2)
+            store.set('a', [(1, 'x')], ['t1'])
+            store.set('b', date(2010, 1, 1), ['t2'])
+            store.close()
+
+            store = DiskStore(path, maxsize=2, ttl=10)
+            self.assertEqual(store.get('a'), [(1, 'x')])
+            store.set('c', None, ['t1', 't2'])
+            self.assertIs(store.get('b'), MISSING)  # least recently used
+            store.invalidate('t2')
+            self.assertIs(store.get('c'), MISSING)
+            self.assertEqual(store.get('a'), [(1, 'x')])
+            store.set('d', 4, ['t3'])
+            with mock.patch('dblink.cache.time.time',
+                            return_value=time.time() + 11):
+                self.assertIs(store.get('d'), MISSING)
+            self.assertEqual(store.stats(), {
+                'hits': 2, 'misses': 3, 'evictions': 2, 'invalidations': 1,
+                'size': 1, 'maxsize': 2})
+            store.close()
+
+
+class ReplicaTest(TestCaseBase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.urls = []
+        # every replica holds one distinct row, to tell who answered
+        for name in ('primary', 'r1', 'r2'):
+            url = 'sqlite:///' + os.path.join(self.tmp.name, name + '.db')
+            engine = create_engine(url)
+            create_table(engine)
+            engine.execute("INSERT INTO users (id, name) VALUES (1, ?)", name)
+            engine.dispose()
+            self.urls.append(url)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def answer(self, db, table):
+        return next(table.query.filter(id=1).values_list('name', flat=True))
+
+    def test_round_robin(self):
+        with Database(self.urls[0], replicas=self.urls[1:]) as db:
+            user_table = Table('users', db)
+            # every read hands its replica connection back
+            self.assertEqual(
+                [self.answer(db, user_table) for _ in range(4)],
+                ['r1', 'r2', 'r1', 'r2'])
+            self.assertEqual(user_table.query.one().name, 'r1')
+            self.assertEqual(user_table.query.first().name, 'r2')
+            self.assertEqual([s['in_use'] for s in db.replica_status()],
+                             [0, 0])
+
+            # a stream keeps its replica until it is exhausted
+            rows = user_table.query.stream()
+            self.assertEqual(next(rows).name, 'r1')
+            self.assertEqual(user_table.query.one().name, 'r1')
+            self.assertEqual(list(rows), [])
+            self.assertEqual(user_table.query.one().name, 'r2')
+
+            with db.primary():
+                self.assertEqual(user_table.query.one().name, 'primary')
+
+    def test_writes_on_primary(self):
+        with Database(self.urls[0], replicas=self.urls[1:]) as db:
+            user_table = Table('users', db)
+            user_table.bulk_insert([{'id': 2, 'name': 'new'}])
+            user_table.bulk_update([{'id': 1, 'name': 'changed'}],
+                                   ['id'], ['name'])
+            row, created = user_table.get_or_insert(id=3, name='created')
+            self.assertTrue(created)
+            self.assertEqual(row.name, 'created')
+            self.assertEqual(user_table.get_or_insert_many(
+                [{'id': 3}, {'id': 4}], ['id'])[1][1], True)
+            user_table.query.filter(id=4).delete()
+
+            self.assertEqual(sorted(user_table.query.values_list(
+                'id', flat=True)), [1])
+            with db.primary():
+                self.assertEqual(sorted(user_table.query.values_list(
+                    'id', flat=True)), [1, 2, 3])
+                self.assertEqual(user_table.query.filter(id=1).one().name,
+                                 'changed')
+            db.remove_session()
+
+    def test_read_your_writes(self):
+        with Database(self.urls[0], replicas=self.urls[1:],
+                      read_your_writes=60) as db:
+            user_table = Table('users', db)
+            self.assertEqual(user_table.query.one().name, 'r1')
+            user_table.bulk_insert([{'id': 2, 'name': 'new'}])
+            self.assertEqual(len(user_table.query.all()), 2)
+            db.remove_session()
+            # a new session has not written anything
+            self.assertEqual(len(user_table.query.all()), 1)
+
+    def test_least_connections_and_failover(self):
+        down = 'sqlite:///' + os.path.join(self.tmp.name, 'no', 'r.db')
+        with Database(self.urls[0], replicas=[down, self.urls[1]],
+                      routing='least_connections') as db:
+            user_table = Table('users', db)
+            # The unreachable replica is marked down and skipped.
+            self.assertEqual(self.answer(db, user_table), 'r1')
+            self.assertEqual(self.answer(db, user_table), 'r1')
+            status = db.replica_status()
+            self.assertEqual([s['healthy'] for s in status], [False, True])
+            self.assertEqual(status[0]['failures'], 1)
+
+            self.assertEqual(status[1]['in_use'], 0)
+            rows = user_table.query.stream()
+            self.assertEqual(next(rows).name, 'r1')
+            self.assertEqual(db.replica_status()[1]['in_use'], 1)
+            rows.close()
+            db.remove_session()
+            self.assertEqual(db.replica_status()[1]['in_use'], 0)
+
+        with Database(self.urls[0], replicas=self.urls[1:],
+                      routing='least_connections') as db:
+            user_table = Table('users', db)
+            rows = user_table.query.stream()
+            self.assertEqual(next(rows).name, 'r1')
+            # r1 is busy with the open stream of this thread
+            names = []
+            thread = threading.Thread(
+                target=lambda: names.append(self.answer(db, user_table)))
+            thread.start()
+            thread.join()
+            self.assertEqual(names, ['r2'])
+            rows.close()
+            db.remove_session()
+
+        with Database(self.urls[0], replicas=[down]) as db:
+            self.assertEqual(self.answer(db, Table('users', db)), 'primary')
+        with self.assertRaises(UnexpectedParam):
+            Database(self.urls[0], replicas=[down], routing='random')
+
+
+class TransferTest(TestCaseBase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database('sqlite:///' +
+                           os.path.join(self.tmp.name, 'db.sqlite'))
+        create_table(self.db.engine)
+        self.user_table = Table('users', self.db)
+        self.user_table.bulk_insert(
+            {'id': i, 'name': 'n{}'.format(i), 'fullname': None,
+             'password': 'p,"{}"'.format(i)} for i in range(1, 101))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_csv(self):
+        out = io.StringIO()
+        query = self.user_table.query.filter(id__lte=2).order_by('id')
+        self.assertEqual(query.export(out), 2)
+        self.assertEqual(out.getvalue().splitlines(), [
+            'id,name,fullname,password',
+            '1,n1,\\N,"p,""1"""',
+            '2,n2,\\N,"p,""2"""'])
+
+        path = os.path.join(self.tmp.name, 'users.csv.gz')
+        self.assertEqual(self.user_table.query.export(path), 100)
+        with gzip.open(path, 'rt') as f:
+            self.assertEqual(len(f.read().splitlines()), 101)
+        self.user_table.query.delete()
+        self.assertEqual(self.user_table.load(path, batch_size=30), 100)
+        self.assertEqual(self.user_table.query.filter(id=7).one(),
+                         (7, 'n7', None, 'p,"7"'))
+
+        out = io.StringIO()
+        query.export(out, null=None)  # empty fields, load() reads ''
+        self.assertEqual(out.getvalue().splitlines()[1], '1,n1,,"p,""1"""')
+        out.seek(0)
+        self.user_table.query.delete()
+        self.assertEqual(self.user_table.load(out, null=None), 2)
+        self.assertEqual(self.user_table.query.filter(id=1).one(),
+                         (1, 'n1', '', 'p,"1"'))
+
+    def test_ndjson(self):
+        birth_table = Table('birth_info', self.db)
+        birth_table.bulk_insert([{'user_id': 1, 'birthday': date(2000, 1, 2)},
+                                 {'user_id': 2, 'birthday': date(2001, 3, 4)}])
+        buffer = io.BytesIO()
+        birth_table.query.order_by('user_id').export(
+            buffer, format='ndjson', compression='gzip')
+        self.assertEqual(gzip.decompress(buffer.getvalue()).decode(),
+                         '{"user_id": 1, "birthday": "2000-01-02"}\n'
+                         '{"user_id": 2, "birthday": "2001-03-04"}\n')
+
+        birth_table.query.delete()
+        buffer.seek(0)
+        self.assertEqual(birth_table.load(buffer, format='ndjson'), 2)
+        self.assertFalse(buffer.closed)
+        self.assertEqual(birth_table.query.filter(user_id=2).one().birthday,
+                         date(2001, 3, 4))
+
+        out = io.StringIO()
+        self.user_table.query.filter(id=3).values('id', 'name') \
+            .export(out, format='ndjson')
+        self.assertEqual(out.getvalue(), '{"id": 3, "name": "n3"}\n')
+        with self.assertRaises(UnexpectedParam):
+            self.user_table.query.export(io.StringIO(), format='xml')
+
+    def test_upsert(self):
+        data = io.StringIO('id,name\n1,changed\n200,new\n')
+        self.assertEqual(self.user_table.load(data, mode='upsert',
+                                              unique_fields=['id']), 2)
+        self.assertEqual(self.user_table.query.count(), 101)
+        self.assertEqual(self.user_table.query.filter(id=1).one(),
+                         (1, 'changed', None, 'p,"1"'))
+        self.assertEqual(self.user_table.load(io.StringIO('')), 0)
+        with self.assertRaises(ValueError):
+            self.user_table.load(io.StringIO('id,age\n1,2\n'))
+        with self.assertRaises(ValueError):
+            self.user_table.load(io.StringIO('id\n1\n'), mode='upsert')
+        with self.assertRaises(UnexpectedParam):
+            self.user_table.load(io.StringIO('id\n1\n'), mode='replace')
+
+    def test_join_export(self):
+        address_table = Table('addresses', self.db)
+        address_table.insert({'id': 7, 'user_id': 1, 'email_address': 'x'})
+        out = io.StringIO()
+        self.user_table.join(address_table) \
+            .values('users.id', 'addresses.id', 'email_address') \
+            .export(out, format='ndjson')
+        self.assertEqual(
+            out.getvalue(),
+            '{"users_id": 1, "addresses_id": 7, "email_address": "x"}\n')
+
+    def test_load_failure(self):
+        self.user_table.query.delete()
+        data = 'id,name\n' + ''.join('{},n\n'.format(i) for i in range(10))
+        with self.assertRaises(ValueError):
+            self.user_table.load(io.StringIO(data + 'x,n\n'), batch_size=3)
+        self.user_table.insert({'id': 100})
+        self.db.remove_session()
+        self.assertEqual(self.user_table.query.count(), 1)